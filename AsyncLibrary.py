@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# Generate Eagle CAD libraries of rasterized text from asyncio code
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Rendering and writing run in an executor, so the event loop is never
+# blocked for longer than it takes to build one package:
+#   async for spec, package in generate_library_async(specs, 'labels.lbr'):
+#       ...
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import ExitStack
+import os
+import sys
+import threading
+
+from Eagle import EagleLibraryFile
+from Label import (LabelRenderer, LabelInterner, check_renderer_options, build_package, build_deviceset,
+                   init_worker, render_in_worker)
+
+
+# Each executor thread keeps its own renderer, since a renderer's Cairo
+# state can't be shared between threads.
+_thread_state = threading.local()
+
+def _render_in_thread(spec, renderer_options):
+    renderer = getattr(_thread_state, 'renderer', None)
+    if renderer is None or _thread_state.options != renderer_options:
+        renderer = _thread_state.renderer = LabelRenderer(**renderer_options)
+        _thread_state.options = renderer_options
+    return renderer.render(spec)
+
+
+# Start streaming a library to outfile (a binary file or a file name),
+# with files closing the stream (and the file, if it was opened here).  A
+# file name is written to a temporary file beside it, as by
+# Library.write_replacing(), whose name is returned with the stream.
+def _open_library(files, outfile):
+    temp = None
+    if isinstance(outfile, str):
+        temp = '%s.%d.tmp' % (outfile, os.getpid())
+        outfile = files.enter_context(open(temp, 'wb'))
+    return files.enter_context(EagleLibraryFile().stream(outfile)), temp
+
+
+def _finish_library(files, temp, outfile):
+    files.close()
+    if temp is not None:
+        os.replace(temp, outfile)
+
+
+def _write_label(stream, spec, package):
+    stream.add_package(package)
+    stream.add_deviceset(build_deviceset(spec))
+
+
+async def _aiter(labels):
+    if hasattr(labels, '__aiter__'):
+        async for spec in labels:
+            yield spec
+    else:
+        for spec in labels:
+            yield spec
+
+
+# Render labels (an iterable or async iterable of Label.LabelSpec),
+# yielding (spec, package) pairs as each label is finished, which need not
+# be in the order given.  As for Library.generate_library(), labels that
+# differ only in name share one package (see Label.LabelInterner): those
+# after the first aren't rendered, and are yielded with None for the
+# package as soon as they are reached.  At most max_concurrency labels are rendered at
+# once, and no more labels are taken from labels until one of those has
+# finished.  Labels are rendered in a pool of threads, or of processes if
+# processes is true (threads only run in parallel while Cairo is drawing,
+# processes also while runs are extracted and decomposed); any other
+# keyword arguments are passed to LabelRenderer.
+#
+# If outfile (a binary file or a file name) is given, the library is
+# written to it as the labels are finished, each package (and its
+# deviceset) before it is yielded, so that packages aren't kept; they are
+# in the order they were finished in.  Writing is done in a thread so that
+# the loop carries on meanwhile.
+async def generate_library_async(labels, outfile = None, max_concurrency = 4, processes = False,
+                                 **renderer_options):
+    loop = asyncio.get_running_loop()
+    check_renderer_options(**renderer_options)
+    if processes:
+        executor = ProcessPoolExecutor(max_workers = max_concurrency,
+                                       initializer = init_worker,
+                                       initargs = (renderer_options,))
+        render = lambda spec: loop.run_in_executor(executor, render_in_worker, spec)
+    else:
+        executor = ThreadPoolExecutor(max_workers = max_concurrency)
+        render = lambda spec: loop.run_in_executor(executor, _render_in_thread, spec, renderer_options)
+
+    files = ExitStack()
+    stream = temp = None
+    interner = LabelInterner()
+    pending = { }
+    try:
+        if outfile is not None:
+            stream, temp = await loop.run_in_executor(None, _open_library, files, outfile)
+        labels = _aiter(labels)
+        exhausted = False
+        while not exhausted or pending:
+            while not exhausted and len(pending) < max_concurrency:
+                try:
+                    spec = await labels.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                package_name = interner.intern(spec)
+                if package_name is None:
+                    continue
+                if package_name != spec.name:
+                    if stream is not None:
+                        await loop.run_in_executor(None, stream.add_deviceset,
+                                                   build_deviceset(spec, package_name))
+                    yield spec, None
+                    continue
+                pending[asyncio.ensure_future(render(spec))] = spec
+            if not pending:
+                break
+            done, _ = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+            for future in done:
+                spec = pending.pop(future)
+                package = build_package(spec, future.result())
+                if stream is not None:
+                    await loop.run_in_executor(None, _write_label, stream, spec, package)
+                yield spec, package
+    except BaseException:
+        # Leave the library unfinished, but close the file, and remove it
+        # if it was opened here.
+        files.__exit__(*sys.exc_info())
+        if temp is not None:
+            os.unlink(temp)
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait = False)
+
+    await loop.run_in_executor(None, _finish_library, files, temp, outfile)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+# On-disk cache of rendered labels
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+
+
+# Each entry is a small header followed by the rectangles or polygons of a
+# RenderedLabel as little-endian 32-bit integers:
+#   rectangles: the flat (x1, row1, x2, row2) array
+#   polygons:   the vertex count of each polygon, then the flat (x, y)
+#               vertices of all of them
+_magic = b'ETRC'
+_version = 2
+_header = struct.Struct('<4sIiiddqqiBqq')
+_kind_rects = 0
+_kind_polygons = 1
+
+
+def _int_array(data):
+    a = array.array('i')
+    a.frombytes(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+def _int_bytes(values):
+    a = array.array('i', values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tobytes()
+
+
+def encode_rendered(rendered):
+    if rendered.polygons is not None:
+        lengths = [len(polygon) for polygon in rendered.polygons]
+        coords = [c for polygon in rendered.polygons for vertex in polygon for c in vertex]
+        body = _int_bytes(lengths) + _int_bytes(coords)
+        kind, count_a, count_b = _kind_polygons, len(lengths), len(coords)
+    else:
+        body = _int_bytes(rendered.rects)
+        kind, count_a, count_b = _kind_rects, len(rendered.rects), 0
+    return _header.pack(_magic, _version, rendered.width_pixels, rendered.height_pixels,
+                        rendered.origin[0], rendered.origin[1],
+                        rendered.run_count, rendered.removed,
+                        -1 if rendered.error is None else rendered.error,
+                        kind, count_a, count_b) + body
+
+
+# Returns the fields of a RenderedLabel, apart from seconds, as a tuple,
+# or raises ValueError if data isn't a complete entry.
+def decode_rendered(data):
+    if len(data) < _header.size:
+        raise ValueError('truncated cache entry')
+    (magic, version, width_pixels, height_pixels, x_origin, y_origin,
+     run_count, removed, error, kind, count_a, count_b) = _header.unpack_from(data)
+    if magic != _magic or version != _version:
+        raise ValueError('not a cache entry')
+    if len(data) != _header.size + 4 * (count_a + count_b):
+        raise ValueError('truncated cache entry')
+    values = data[_header.size:]
+    rects = None
+    polygons = None
+    if kind == _kind_rects:
+        rects = _int_array(values)
+    else:
+        lengths = _int_array(values[:4 * count_a])
+        coords = _int_array(values[4 * count_a:])
+        polygons = []
+        i = 0
+        for length in lengths:
+            it = iter(coords[i:i + 2 * length])
+            polygons.append(list(zip(it, it)))
+            i += 2 * length
+    if error < 0:
+        error = None
+    return (width_pixels, height_pixels, (x_origin, y_origin), run_count, rects, removed, polygons, error)
+
+
+# A directory of rendered labels, keyed by a hash of everything that
+# affects the rendering: the key parameters given to key(), the Cairo and
+# cairocffi versions, and stamp, which the caller can use for anything
+# else the output depends on (e.g., the version of the installed fonts).
+# Once the entries total more than max_bytes, the least recently used are
+# removed (each hit updates its entry's modification time) until they are
+# below three quarters of that.  Entries are written to a temporary file
+# and renamed into place, so a partly written entry is never read.
+#
+# Several processes may share the directory (each worker of a parallel
+# build has a copy of the same RenderCache), and each only knows about the
+# entries it added itself, so the directory is scanned again for the true
+# total after every max_bytes / 16 bytes added.
+class RenderCache:
+    def __init__(self, directory, max_bytes = 256 << 20, stamp = ''):
+        import cairocffi
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.environment = { 'cairo':     cairocffi.cairo_version_string(),
+                             'cairocffi': cairocffi.version,
+                             'format':    _version,
+                             'stamp':     stamp }
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok = True)
+        self.evict()
+
+    def key(self, params):
+        text = json.dumps([params, self.environment], sort_keys = True)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:] + '.bin')
+
+    def _entries(self):
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.bin'):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, st.st_size, st.st_mtime
+
+    # Returns the cached fields of a RenderedLabel (see decode_rendered()),
+    # or None.
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            fields = decode_rendered(data)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return fields
+
+    def put(self, key, rendered):
+        path = self._path(key)
+        data = encode_rendered(rendered)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with tempfile.NamedTemporaryFile(dir = os.path.dirname(path), suffix = '.tmp',
+                                         delete = False) as f:
+            f.write(data)
+        # An entry being replaced no longer counts.
+        try:
+            self.total_bytes -= os.stat(path).st_size
+        except FileNotFoundError:
+            pass
+        os.replace(f.name, path)
+        self.total_bytes += len(data)
+        self.unscanned_bytes += len(data)
+        if self.total_bytes > self.max_bytes or self.unscanned_bytes > self.max_bytes // 16:
+            self.evict()
+
+    # Scan the directory for the total size of the entries, and if it is
+    # more than max_bytes, remove the least recently used.
+    def evict(self):
+        entries = sorted(self._entries(), key = lambda entry: entry[2])
+        self.total_bytes = sum(size for path, size, mtime in entries)
+        self.unscanned_bytes = 0
+        if self.total_bytes <= self.max_bytes:
+            return
+        for path, size, mtime in entries:
+            if self.total_bytes <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+# Decompose raster runs into larger primitives
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+from bisect import bisect_left, bisect_right
+from itertools import groupby
+from operator import itemgetter
+
+
+# Merge runs with identical x1/x2 spans on consecutive rows into single
+# rectangles.  runs is a flat sequence of (row, x1, x2) triples as returned
+# by Rasterize.extract_runs(), grouped by row in either increasing or
+# decreasing row order.  The result is a flat array('i') of
+# (x1, row1, x2, row2) rectangles in surface pixel coordinates, covering
+# rows row1 <= row < row2, along with the number of runs that were
+# absorbed into another rectangle (i.e., the number of primitives saved).
+def coalesce_runs(runs):
+    rects = array.array('i')
+    open_spans = { }     # (x1, x2) -> row at which the span started
+    last_row = None
+    run_count = 0
+
+    def close(spans, end_row):
+        for (x1, x2), start_row in spans.items():
+            rects.extend((x1, min(start_row, end_row),
+                          x2, max(start_row, end_row) + 1))
+
+    it = iter(runs)
+    for row, group in groupby(zip(it, it, it), key = itemgetter(0)):
+        if last_row is not None and abs(row - last_row) != 1:
+            close(open_spans, last_row)
+            open_spans = { }
+        continued = { }
+        for _, x1, x2 in group:
+            run_count += 1
+            span = (x1, x2)
+            continued[span] = open_spans.pop(span, row)
+        close(open_spans, last_row)
+        open_spans = continued
+        last_row = row
+    if last_row is not None:
+        close(open_spans, last_row)
+
+    return rects, run_count - len(rects) // 4
+
+
+# Merge runs into rectangles like coalesce_runs(), but allow the result to
+# differ from the runs by up to tolerance pixels along each row: runs in a
+# row separated by gaps of up to 2 * tolerance pixels are joined, and runs
+# on consecutive rows are merged into one rectangle as long as their left
+# ends, and their right ends, each stay within a range of 2 * tolerance
+# pixels, with the rectangle's edges in the middle of those ranges.  Returns
+# (rects, removed, error), where error is the achieved deviation: the
+# farthest that any pixel whose coverage changed lies, along its row, from
+# a pixel that had its new coverage originally.  It is never more than
+# tolerance.  runs must be grouped by row, as for coalesce_runs().
+def simplify_runs(runs, tolerance):
+    tolerance = int(tolerance)
+    limit = 2 * tolerance
+    rects = array.array('i')
+    original_spans = { }
+    open_rects = []      # [x1 low, x1 high, x2 low, x2 high, start row], by x1 low
+    last_row = None
+    run_count = 0
+
+    def close(rect, end_row):
+        lo1, hi1, lo2, hi2, start_row = rect
+        rects.extend(((lo1 + hi1) // 2, min(start_row, end_row),
+                      (lo2 + hi2 + 1) // 2, max(start_row, end_row) + 1))
+
+    it = iter(runs)
+    for row, group in groupby(zip(it, it, it), key = itemgetter(0)):
+        spans = sorted((x1, x2) for _, x1, x2 in group)
+        run_count += len(spans)
+        original_spans[row] = spans
+        joined = [list(spans[0])]
+        for x1, x2 in spans[1:]:
+            if x1 - joined[-1][1] <= limit:
+                joined[-1][1] = x2
+            else:
+                joined.append([x1, x2])
+
+        if last_row is not None and abs(row - last_row) != 1:
+            for rect in open_rects:
+                close(rect, last_row)
+            open_rects = []
+        lows = [rect[0] for rect in open_rects]
+        continued = set()
+        next_open = []
+        for x1, x2 in joined:
+            i = bisect_left(lows, x1 - limit)
+            while i < len(open_rects) and lows[i] <= x1 + limit:
+                lo1, hi1, lo2, hi2, start_row = open_rects[i]
+                if (i not in continued and
+                    max(hi1, x1) - min(lo1, x1) <= limit and
+                    max(hi2, x2) - min(lo2, x2) <= limit):
+                    continued.add(i)
+                    next_open.append([min(lo1, x1), max(hi1, x1), min(lo2, x2), max(hi2, x2), start_row])
+                    break
+                i += 1
+            else:
+                next_open.append([x1, x1, x2, x2, row])
+        for i, rect in enumerate(open_rects):
+            if i not in continued:
+                close(rect, last_row)
+        open_rects = sorted(next_open)
+        last_row = row
+    for rect in open_rects:
+        close(rect, last_row)
+
+    return rects, run_count - len(rects) // 4, _coverage_error(original_spans, rects)
+
+
+# The union of the rectangles' spans on each row.
+def _row_spans(rects):
+    spans_by_row = { }
+    it = iter(rects)
+    for x1, row1, x2, row2 in zip(it, it, it, it):
+        for row in range(row1, row2):
+            spans_by_row.setdefault(row, []).append((x1, x2))
+    for row, spans in spans_by_row.items():
+        spans.sort()
+        union = [list(spans[0])]
+        for x1, x2 in spans[1:]:
+            if x1 <= union[-1][1]:
+                union[-1][1] = max(union[-1][1], x2)
+            else:
+                union.append([x1, x2])
+        spans_by_row[row] = [tuple(span) for span in union]
+    return spans_by_row
+
+
+# Convert rectangles back to runs, in increasing row order.
+def rects_to_runs(rects):
+    runs = array.array('i')
+    for row, spans in sorted(_row_spans(rects).items()):
+        for x1, x2 in spans:
+            runs.extend((row, x1, x2))
+    return runs
+
+
+# The largest distance, over the pixels in [a, b), to the nearest pixel
+# outside the interval [lo, hi) that contains them.  Either end may be
+# None, for no pixel outside on that side.
+def _interval_distance(a, b, lo, hi):
+    def distance(x):
+        d = []
+        if lo is not None:
+            d.append(x - lo + 1)
+        if hi is not None:
+            d.append(hi - x)
+        return min(d)
+    if lo is None or hi is None:
+        return max(distance(a), distance(b - 1))
+    middle = (lo + hi - 1) // 2
+    return max(distance(x) for x in { a, b - 1, min(max(middle, a), b - 1),
+                                      min(max(middle + 1, a), b - 1) })
+
+
+def _coverage_error(original_spans, rects):
+    error = 0
+    new_spans = _row_spans(rects)
+    for row in set(original_spans) | set(new_spans):
+        original = original_spans.get(row, [])
+        new = new_spans.get(row, [])
+        starts = [x1 for x1, x2 in original]
+        # Pixels added: distance to the runs on either side of the gap.
+        for a, b in _subtract_spans(new, original):
+            i = bisect_right(starts, a)
+            lo = original[i - 1][1] if i > 0 else None
+            hi = original[i][0] if i < len(original) else None
+            error = max(error, _interval_distance(a, b, lo, hi))
+        # Pixels removed: distance to the gaps on either side of the run.
+        for a, b in _subtract_spans(original, new):
+            i = bisect_right(starts, a) - 1
+            error = max(error, _interval_distance(a, b, original[i][0], original[i][1]))
+    return error
+
+
+# Subtract the sorted, disjoint spans b from the sorted, disjoint spans a.
+def _subtract_spans(a, b):
+    result = []
+    j = 0
+    for x1, x2 in a:
+        while j < len(b) and b[j][1] <= x1:
+            j += 1
+        k = j
+        while k < len(b) and b[k][0] < x2:
+            if b[k][0] > x1:
+                result.append((x1, b[k][0]))
+            x1 = max(x1, b[k][1])
+            k += 1
+        if x1 < x2:
+            result.append((x1, x2))
+    return result
+
+
+# Remove repeated vertices, and vertices in the middle of a straight line,
+# from a closed ring.  A vertex where the ring doubles back on itself (as it
+# does at either end of a hole bridge) is kept.
+def _simplify_ring(ring):
+    changed = True
+    while changed and len(ring) > 2:
+        changed = False
+        result = []
+        n = len(ring)
+        for i in range(n):
+            px, py = ring[i - 1]
+            x, y = ring[i]
+            nx, ny = ring[(i + 1) % n]
+            if (x, y) == (px, py):
+                changed = True
+                continue
+            d1 = (x - px, y - py)
+            d2 = (nx - x, ny - y)
+            if d1[0] * d2[1] == d1[1] * d2[0] and d1[0] * d2[0] + d1[1] * d2[1] > 0:
+                changed = True
+                continue
+            result.append((x, y))
+        ring = result
+    return ring
+
+
+def _ring_area2(ring):
+    area = 0
+    for i in range(len(ring)):
+        x1, y1 = ring[i - 1]
+        x2, y2 = ring[i]
+        area += x1 * y2 - x2 * y1
+    return area
+
+
+# Trace the outlines of the "on" pixels described by runs (a flat sequence
+# of (row, x1, x2) triples in any order) and return a list of polygons, each
+# a list of (x, y) vertices on the pixel lattice, with y increasing downward
+# as in the surface.  Pixels that touch only at a corner belong to separate
+# outlines.  Eagle polygons can't have holes, so each hole is joined to the
+# polygon that surrounds it by a zero-width bridge (a "keyhole"), which
+# leaves the filled area unchanged.  Collinear vertices are merged.
+def trace_polygons(runs):
+    spans_by_row = { }
+    it = iter(runs)
+    for row, x1, x2 in zip(it, it, it):
+        spans_by_row.setdefault(row, []).append((x1, x2))
+    for spans in spans_by_row.values():
+        spans.sort()
+
+    # Directed boundary edges, with the filled area on the right hand side
+    # (in surface coordinates, y down), indexed by starting vertex.
+    outgoing = { }
+    def add_edge(p, q):
+        d = ((q[0] > p[0]) - (q[0] < p[0]), (q[1] > p[1]) - (q[1] < p[1]))
+        outgoing.setdefault(p, []).append((q, d))
+
+    for row, spans in spans_by_row.items():
+        for x1, x2 in spans:
+            add_edge((x1, row + 1), (x1, row))
+            add_edge((x2, row), (x2, row + 1))
+    for y in set(spans_by_row) | { row + 1 for row in spans_by_row }:
+        below = spans_by_row.get(y, [])
+        above = spans_by_row.get(y - 1, [])
+        for x1, x2 in _subtract_spans(below, above):
+            add_edge((x1, y), (x2, y))
+        for x1, x2 in _subtract_spans(above, below):
+            add_edge((x2, y), (x1, y))
+
+    # Follow the edges around each outline.  Where two outlines meet at a
+    # corner, turning right keeps them apart.
+    rings = []
+    for start in list(outgoing):
+        while outgoing.get(start):
+            ring = [start]
+            q, d = outgoing[start].pop()
+            while q != start:
+                ring.append(q)
+                choices = outgoing[q]
+                for turn in ((-d[1], d[0]), d, (d[1], -d[0])):
+                    for i, (next_q, next_d) in enumerate(choices):
+                        if next_d == turn:
+                            break
+                    else:
+                        continue
+                    break
+                q, d = choices.pop(i)
+            rings.append(_simplify_ring(ring))
+
+    outlines = [ring for ring in rings if _ring_area2(ring) > 0]
+    holes = [ring for ring in rings if _ring_area2(ring) < 0]
+
+    # Bridge each hole to whatever edge lies directly above its top left
+    # corner.  Working from the top down, that edge is always part of an
+    # outline or of a hole that has already been bridged into one.
+    for hole in sorted(holes, key = lambda ring: min((y, x) for x, y in ring)):
+        hx, hy = min(hole, key = lambda p: (p[1], p[0]))
+        best = None
+        for outline in outlines:
+            for i in range(len(outline)):
+                (px, py), (qx, qy) = outline[i - 1], outline[i]
+                if (py == qy and py < hy and min(px, qx) <= hx < max(px, qx) and
+                    (best is None or py > best[0])):
+                    best = (py, outline, i)
+        if best is None:
+            raise ValueError('hole at (%d, %d) is not enclosed by any outline' % (hx, hy))
+        ey, outline, i = best
+        h = hole.index((hx, hy))
+        outline[i:i] = [(hx, ey)] + hole[h:] + hole[:h] + [(hx, hy), (hx, ey)]
+
+    return [_simplify_ring(outline) for outline in outlines]
@@ -16,10 +16,125 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from abc import ABCMeta
+import array
 import io
-from xml.etree.ElementTree import ElementTree, Element, SubElement, Comment, tostring
+import shutil
+import tempfile
+from xml.etree.ElementTree import ElementTree, Element, SubElement, Comment, tostring, fromstring, iterparse
+from xml.parsers import expat
+
+
+def _escape_attrib(text):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\r' in text:
+        text = text.replace('\r', '&#13;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    if '\t' in text:
+        text = text.replace('\t', '&#09;')
+    return text
+
+
+def _escape_cdata(text):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+# Eagle's XML reader doesn't like extremely long lines, so every element
+# goes on its own line, indented two spaces per level.  (Eagle doesn't need
+# the indentation, but it makes it easier to inspect the library as text.)
+# The output is the same as indenting the tree and serializing it with
+# xml.etree.ElementTree, but elements are written as they are visited
+# rather than after the whole tree has been built and modified, and
+# nothing is kept once it has been written.
+class EagleXMLWriter:
+    def __init__(self, outfile, buffer_size = 65536):
+        # We can't write XML to a text file (e.g., stdout),
+        # so if it is a text file, get the underlying binary file
+        if isinstance(outfile, io.TextIOBase):
+            outfile = outfile.buffer
+        self.outfile = outfile
+        self.buffer_size = buffer_size
+        self.pieces = []
+        self.pending = 0
+        self.bytes_written = 0
+
+    # pending counts the buffered text in bytes once encoded; checking
+    # for ASCII text, which nearly all of it is, is much quicker than
+    # encoding it.
+    def write(self, s):
+        self.pieces.append(s)
+        self.pending += len(s) if s.isascii() else len(s.encode('utf-8'))
+        if self.pending >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        data = ''.join(self.pieces).encode('utf-8')
+        self.pieces = []
+        self.pending = 0
+        self.outfile.write(data)
+        self.bytes_written += len(data)
+
+    # Write already encoded text.
+    def write_bytes(self, data):
+        self.flush()
+        self.outfile.write(data)
+        self.bytes_written += len(data)
+
+    # The output position in bytes, counting what is still buffered.
+    def tell(self):
+        return self.bytes_written + self.pending
+
+    def write_declaration(self):
+        self.write("<?xml version='1.0' encoding='utf-8'?>\n")
+
+    def _start_tag(self, element, level):
+        if level:
+            prefix = '\n' + '  ' * level + '<'
+        else:
+            prefix = '<'
+        return prefix + element.tag + ''.join([' %s="%s"' % (k, _escape_attrib(v))
+                                               for k, v in element.items()])
+
+    # Write the start tag of an element whose children will be written
+    # separately, followed by end_element().
+    def start_element(self, element, level):
+        self.write(self._start_tag(element, level) + '>')
+
+    def end_element(self, element, level):
+        self.write('\n' + '  ' * level + '</' + element.tag + '>')
+        if not level:
+            self.write('\n')
+
+    # Write an element and all of its children.
+    def write_element(self, element, level):
+        if len(element):
+            self.start_element(element, level)
+            for child in element:
+                self.write_element(child, level + 1)
+            self.end_element(element, level)
+        elif element.text:
+            self.write(self._start_tag(element, level) + '>' + _escape_cdata(element.text) +
+                       '</' + element.tag + '>')
+        else:
+            self.write(self._start_tag(element, level) + ' />')
+
 
 class EagleXMLElement:
+    __slots__ = ('element',)
+
     def __init__(self, name, attrs = None, from_element = None):
         if from_element is None:
             if attrs is None:
@@ -35,6 +150,9 @@ class EagleXMLElement:
     def add_subelement(self, subelement):
         self.element.append(subelement)
 
+    def write_xml(self, writer, level):
+        writer.write_element(self.element, level)
+
 
 class EagleSetting(EagleXMLElement):
     def __init__(self, name, value):
@@ -83,14 +201,19 @@ class EagleLayer(EagleXMLElement):
 
 
 
+# layer_table, if given, is a sequence of (number, name, color, fill,
+# visible, active) tuples to use instead of Eagle's standard layers.
 class EagleLayers(EagleXMLElement):
-    def __init__(self):
+    def __init__(self, layer_table = None):
         super().__init__('layers')
 
         self.layers_by_name = { }
         self.layers_by_number = { }
 
-        for layer in [ EagleLayer(1,  'Top',       4,  1,  True,   True),
+        if layer_table is not None:
+            layers = [EagleLayer(*entry) for entry in layer_table]
+        else:
+            layers = [ EagleLayer(1,  'Top',       4,  1,  True,   True),
                        EagleLayer(2,  'Route2',    1,  3,  False,  True),
                        EagleLayer(3,  'Route3',    4,  3,  False,  True),
                        EagleLayer(4,  'Route4',    1,  4,  False,  True),
@@ -148,67 +271,136 @@ class EagleLayers(EagleXMLElement):
                        EagleLayer(95, 'Names',     7,  1,  True,   True),
                        EagleLayer(96, 'Values',    7,  1,  True,   True),
                        EagleLayer(97, 'Info',      7,  1,  True,   True),
-                       EagleLayer(98, 'Guide',     6,  1,  True,   True) ]:
+                       EagleLayer(98, 'Guide',     6,  1,  True,   True) ]
+        for layer in layers:
             self.layers_by_name [layer.name] = layer
             self.layers_by_number [layer.number] = layer
             self.add_subelement(layer.element)
 
 
 
+# The settings, grid and layers at the start of every file's drawing.
+# They are the same for every file, so rather than each file building and
+# serializing its own, files share an EagleHeader, which builds the
+# elements only if something asks for them, and serializes them once per
+# indentation level.  Whatever asks for the settings, grid or layers may
+# change them, so from then on the header is serialized afresh each time
+# instead.  An EagleFile asked for them gets a header of its own first,
+# leaving the shared one alone.
+class EagleHeader:
+    def __init__(self, layer_table = None):
+        self.layer_table = layer_table
+        self._parts = None
+        self._bytes = { }
+
+    def _get_parts(self):
+        if self._parts is None:
+            self._parts = (EagleSettings(), EagleGrid(), EagleLayers(self.layer_table))
+        return self._parts
+
+    def _get_part(self, index):
+        self._bytes = None
+        return self._get_parts()[index]
+
+    @property
+    def settings(self):
+        return self._get_part(0)
+
+    @property
+    def grid(self):
+        return self._get_part(1)
+
+    @property
+    def layers(self):
+        return self._get_part(2)
+
+    def get_bytes(self, level):
+        data = self._bytes.get(level) if self._bytes is not None else None
+        if data is None:
+            out = io.BytesIO()
+            writer = EagleXMLWriter(out)
+            for part in self._get_parts():
+                writer.write_element(part.get_element(), level)
+            writer.flush()
+            data = out.getvalue()
+            if self._bytes is not None:
+                self._bytes[level] = data
+        return data
+
+
+_default_header = None
+
+def default_header():
+    global _default_header
+    if _default_header is None:
+        _default_header = EagleHeader()
+    return _default_header
+
+
 class EagleFile(metaclass = ABCMeta):
-    def __init__(self):
+    def __init__(self, header = None):
         self.eagle = Element('eagle', { 'version': '6.5.0' })
         self.drawing = SubElement(self.eagle, 'drawing')
-
-        self.settings = EagleSettings()
-        self.drawing.append(self.settings.get_element())
-
-        self.grid = EagleGrid()
-        self.drawing.append(self.grid.get_element())
-
-        self.layers = EagleLayers()
-        self.drawing.append(self.layers.get_element())
-
-    # Eagle's XML reader doesn't like extremely long lines, and xml.etree.ElementTree
-    # doesn't have built-in support for pretty printing, so this function can be used
-    # to add suitable 'tails' to each element for newlines and indentation.  (Eagle
-    # doesn't need the indentation, but it makes it easier to inspect the library as
-    # text.)
-    #   http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
-    def _indent(self, elem, level=0):
-        i = "\n" + level*"  "
-        if len(elem):
-            if not elem.text or not elem.text.strip():
-                elem.text = i + "  "
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
-            for elem in elem:
-                self._indent(elem, level+1)
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
-        else:
-            if level and (not elem.tail or not elem.tail.strip()):
-                elem.tail = i
-        
-
+        if header is None:
+            header = default_header()
+        self.header = header
+        self._own_header = False
+
+    # The header may be shared with other files, so this file gets a copy
+    # of its own before handing out anything that could be changed.
+    def _get_own_header(self):
+        if not self._own_header:
+            self.header = EagleHeader(self.header.layer_table)
+            self._own_header = True
+        return self.header
+
+    @property
+    def settings(self):
+        return self._get_own_header().settings
+
+    @property
+    def grid(self):
+        return self._get_own_header().grid
+
+    @property
+    def layers(self):
+        return self._get_own_header().layers
+
+    # Write the drawing's children.  Subclasses that keep their content
+    # in wrapper objects override this to let the wrappers write it.
+    def write_drawing(self, writer, level):
+        writer.write_bytes(self.header.get_bytes(level))
+        for element in self.drawing:
+            writer.write_element(element, level)
+
+    # outfile is a file or, as for ElementTree.write(), a file name.
     def write(self, outfile):
-        # We can't write XML to a text file (e.g., stdout),
-        # so if it is a text file, get the underlying binary file
-        if isinstance(outfile, io.TextIOBase):
-            outfile = outfile.buffer
-
-        self._indent(self.eagle)
-        doc = ElementTree(self.eagle)
-        doc.write(outfile, encoding='utf-8', xml_declaration=True)
-
-
-
+        if isinstance(outfile, str):
+            with open(outfile, 'wb') as f:
+                return self.write(f)
+        writer = EagleXMLWriter(outfile)
+        writer.write_declaration()
+        writer.start_element(self.eagle, 0)
+        writer.start_element(self.drawing, 1)
+        self.write_drawing(writer, 2)
+        writer.end_element(self.drawing, 1)
+        writer.end_element(self.eagle, 0)
+        writer.flush()
+        return writer.bytes_written
+
+
+
+# Primitives are created in large numbers, so they have no __dict__.
 class EaglePrimitive(EagleXMLElement):
+    __slots__ = ()
+
     def __init__(self, kind, attrs):
         super().__init__(kind, attrs)
 
 
 class EagleRectangle(EaglePrimitive):
+    __slots__ = ()
+
     def __init__(self, layer, x1, y1, x2, y2):
         super().__init__('rectangle', { 'layer': str(layer),
                                         'x1': '%.6f' % x1,
@@ -217,26 +409,175 @@ class EagleRectangle(EaglePrimitive):
                                         'y2': '%.6f' % y2 })
 
 
+class EagleVertex(EagleXMLElement):
+    __slots__ = ()
+
+    def __init__(self, x, y):
+        super().__init__('vertex', { 'x': '%.6f' % x,
+                                     'y': '%.6f' % y })
+
+
+# Eagle polygons can't have holes; cut a zero-width channel from the
+# outline to each hole and trace the hole as part of the outline.
+class EaglePolygon(EaglePrimitive):
+    __slots__ = ('vertices',)
+
+    def __init__(self, layer, vertices, width = 0):
+        super().__init__('polygon', { 'width': '%.6f' % width,
+                                      'layer': str(layer) })
+        self.vertices = []
+        for x, y in vertices:
+            vertex = EagleVertex(x, y)
+            self.vertices.append(vertex)
+            self.add_subelement(vertex.get_element())
+
+
+class EagleDescription(EagleXMLElement):
+    def __init__(self, text):
+        super().__init__('description')
+        self.element.text = text
+
+
+# A package read from a file (from_element) keeps its primitives as plain
+# elements; primitives only lists those added since.
 class EaglePackage(EagleXMLElement):
-    def __init__(self, name):
-        super().__init__('package', {'name': name })
-        self.name = name
+    def __init__(self, name, from_element = None):
+        super().__init__('package', {'name': name }, from_element)
+        self.name = self.element.get('name')
         self.primitives = []
+        self.description = self.element.find('description')
+
+    # The description has to come before the primitives.
+    def set_description(self, text):
+        if self.description is None:
+            self.description = EagleDescription(text).get_element()
+            self.element.insert(0, self.description)
+        else:
+            self.description.text = text
+
+    def get_description(self):
+        if self.description is None:
+            return None
+        return self.description.text
 
     def add_primitive(self, primitive):
         self.primitives.append(primitive)
         self.add_subelement(primitive.get_element())
 
+    def add_rectangle(self, layer, x1, y1, x2, y2):
+        self.add_primitive(EagleRectangle(layer, x1, y1, x2, y2))
+
+
+# A package that keeps its rectangles as numbers in typed arrays (about
+# 36 bytes per rectangle) rather than as EagleRectangle wrappers and
+# elements, and only turns them into XML when it is written.  The
+# package element returned by get_element() has no rectangle children;
+# use materialize() to get a complete element tree.  Other primitives
+# are kept as usual, and are written after the rectangles.
+#
+# Rectangles on a pixel grid can instead be added in batches with
+# add_pixel_rectangles(), as a flat array of integer (x1, row1, x2, row2)
+# rectangles and three lookups (lists, or dicts that fill themselves in)
+# from a pixel x or row to the text of the Eagle coordinate: x_text for
+# x1 and x2, y1_text for row2 (the bottom edge), and y2_text for row1.
+# Each distinct coordinate is then converted and formatted only once.
+# They are written after any rectangles added by add_rectangle().
+class EagleCompactPackage(EaglePackage):
+    _rectangle_format = '<rectangle layer="%d" x1="%.6f" y1="%.6f" x2="%.6f" y2="%.6f" />'
+    _pixel_rectangle_format = '<rectangle layer="%d" x1="%s" y1="%s" x2="%s" y2="%s" />'
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.layers = array.array('i')
+        self.coords = array.array('d')
+        self.pixel_batches = []
+
+    def add_rectangle(self, layer, x1, y1, x2, y2):
+        self.layers.append(layer)
+        self.coords.extend((x1, y1, x2, y2))
+
+    def add_pixel_rectangles(self, layer, rects, x_text, y1_text, y2_text):
+        self.pixel_batches.append((layer, rects, x_text, y1_text, y2_text))
+
+    def rectangle_count(self):
+        return len(self.layers) + sum(len(batch[1]) // 4 for batch in self.pixel_batches)
+
+    def _iter_float_rectangles(self):
+        it = iter(self.coords)
+        return zip(self.layers, it, it, it, it)
+
+    def iter_rectangles(self):
+        yield from self._iter_float_rectangles()
+        for layer, rects, x_text, y1_text, y2_text in self.pixel_batches:
+            it = iter(rects)
+            for x1, row1, x2, row2 in zip(it, it, it, it):
+                yield (layer, float(x_text[x1]), float(y1_text[row2]),
+                       float(x_text[x2]), float(y2_text[row1]))
+
+    # The children of the package element other than the description,
+    # which go after the rectangles.
+    def _other_children(self):
+        return [child for child in self.element if child is not self.description]
+
+    def materialize(self):
+        element = Element('package', self.element.attrib)
+        if self.description is not None:
+            element.append(self.description)
+        for layer, x1, y1, x2, y2 in self.iter_rectangles():
+            element.append(EagleRectangle(layer, x1, y1, x2, y2).get_element())
+        element.extend(self._other_children())
+        return element
+
+    def write_xml(self, writer, level):
+        if not self.layers and not self.pixel_batches:
+            super().write_xml(writer, level)
+            return
+        writer.start_element(self.element, level)
+        if self.description is not None:
+            writer.write_element(self.description, level + 1)
+        line = '\n' + '  ' * (level + 1) + self._rectangle_format
+        pieces = []
+        for rectangle in self._iter_float_rectangles():
+            pieces.append(line % rectangle)
+            if len(pieces) >= 1024:
+                writer.write(''.join(pieces))
+                pieces = []
+        writer.write(''.join(pieces))
+        line = '\n' + '  ' * (level + 1) + self._pixel_rectangle_format
+        for layer, rects, x_text, y1_text, y2_text in self.pixel_batches:
+            it = iter(rects)
+            pieces = []
+            for x1, row1, x2, row2 in zip(it, it, it, it):
+                pieces.append(line % (layer, x_text[x1], y1_text[row2], x_text[x2], y2_text[row1]))
+                if len(pieces) >= 1024:
+                    writer.write(''.join(pieces))
+                    pieces = []
+            writer.write(''.join(pieces))
+        for child in self._other_children():
+            writer.write_element(child, level + 1)
+        writer.end_element(self.element, level)
+
 
 class EaglePackages(EagleXMLElement):
     def __init__(self):
         super().__init__('packages')
         self.packages = {}
+        self.package_list = []
 
     def add_package(self, package):
         self.packages [package.name] = package
+        self.package_list.append(package)
         self.add_subelement(package.get_element())
 
+    def write_xml(self, writer, level):
+        if not self.package_list:
+            writer.write_element(self.element, level)
+            return
+        writer.start_element(self.element, level)
+        for package in self.package_list:
+            package.write_xml(writer, level + 1)
+        writer.end_element(self.element, level)
+
 
 class EagleSymbols(EagleXMLElement):
     def __init__(self):
@@ -278,9 +619,14 @@ class EagleDevices(EagleXMLElement):
         self.add_subelement(device.get_element())
 
 
+# A deviceset read from a file (from_element) is kept as it is, and
+# can't have devices added.
 class EagleDeviceset(EagleXMLElement):
-    def __init__(self, name):
-        super().__init__('deviceset', { 'name': name })
+    def __init__(self, name, from_element = None):
+        super().__init__('deviceset', { 'name': name }, from_element)
+        self.name = self.element.get('name')
+        if from_element is not None:
+            return
         self.gates = EagleGates()
         self.add_subelement(self.gates.get_element())
         self.devices = EagleDevices()
@@ -316,10 +662,17 @@ class EagleLibrary(EagleXMLElement):
     def add_package(self, package):
         self.packages.add_package(package)
 
+    def write_xml(self, writer, level):
+        writer.start_element(self.element, level)
+        self.packages.write_xml(writer, level + 1)
+        self.symbols.write_xml(writer, level + 1)
+        self.devicesets.write_xml(writer, level + 1)
+        writer.end_element(self.element, level)
+
 
 class EagleLibraryFile(EagleFile):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, header = None):
+        super().__init__(header)
         self.library = EagleLibrary()
         self.drawing.append(self.library.get_element())
 
@@ -329,6 +682,243 @@ class EagleLibraryFile(EagleFile):
     def add_package(self, package):
         self.library.add_package(package)
 
+    def write_drawing(self, writer, level):
+        writer.write_bytes(self.header.get_bytes(level))
+        for element in self.drawing:
+            if element is self.library.get_element():
+                self.library.write_xml(writer, level)
+            else:
+                writer.write_element(element, level)
+
+    # Write the library incrementally: packages are written and released
+    # as soon as they are added, rather than kept until the whole library
+    # has been built.
+    #   with lib.stream(outfile) as stream:
+    #       stream.add_package(package)
+    #       stream.add_deviceset(deviceset)
+    def stream(self, outfile):
+        return EagleLibraryStream(self, outfile)
+
+
+# Devicesets come after packages in the file, so they are serialized as
+# they are added into a temporary file (in memory until it gets large),
+# and copied to the output after the last package.
+class EagleLibraryStream:
+    def __init__(self, library_file, outfile, spool_size = 1 << 20):
+        self.library_file = library_file
+        self.library = library_file.library
+        self.writer = EagleXMLWriter(outfile)
+        self.spool = tempfile.SpooledTemporaryFile(max_size = spool_size)
+        self.deviceset_writer = EagleXMLWriter(self.spool)
+        self.packages_started = False
+        self.deviceset_count = 0
+        self.closed = False
+
+        self.writer.write_declaration()
+        self.writer.start_element(library_file.eagle, 0)
+        self.writer.start_element(library_file.drawing, 1)
+        self.writer.write_bytes(library_file.header.get_bytes(2))
+        for element in library_file.drawing:
+            if element is self.library.get_element():
+                break
+            self.writer.write_element(element, 2)
+        self.writer.start_element(self.library.get_element(), 2)
+        for package in self.library.packages.package_list:
+            self.add_package(package)
+        for deviceset in self.library.devicesets.devicesets:
+            self.add_deviceset(deviceset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.spool.close()
+
+    # add_package() and add_deviceset() return the number of bytes the
+    # package or deviceset added to the output.
+    def add_package(self, package):
+        start = self.writer.tell()
+        if not self.packages_started:
+            self.writer.start_element(self.library.packages.get_element(), 3)
+            self.packages_started = True
+        package.write_xml(self.writer, 4)
+        return self.writer.tell() - start
+
+    def add_deviceset(self, deviceset):
+        start = self.deviceset_writer.tell()
+        deviceset.write_xml(self.deviceset_writer, 4)
+        self.deviceset_count += 1
+        return self.deviceset_writer.tell() - start
+
+    # Add a package or deviceset (as kind says) that is already serialized,
+    # such as one copied from another library by the offsets that
+    # scan_library() found.  Returns the number of bytes it added.
+    def add_raw(self, kind, data):
+        if kind == 'package':
+            writer = self.writer
+            start = writer.tell()
+            if not self.packages_started:
+                writer.start_element(self.library.packages.get_element(), 3)
+                self.packages_started = True
+        else:
+            writer = self.deviceset_writer
+            start = writer.tell()
+            self.deviceset_count += 1
+        writer.write('\n' + '  ' * 4)
+        writer.write_bytes(data)
+        return writer.tell() - start
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        writer = self.writer
+        if self.packages_started:
+            writer.end_element(self.library.packages.get_element(), 3)
+        else:
+            writer.write_element(self.library.packages.get_element(), 3)
+        self.library.symbols.write_xml(writer, 3)
+        devicesets = self.library.devicesets.get_element()
+        if self.deviceset_count:
+            writer.start_element(devicesets, 3)
+            writer.flush()
+            self.deviceset_writer.flush()
+            self.spool.seek(0)
+            shutil.copyfileobj(self.spool, writer.outfile)
+            writer.bytes_written += self.deviceset_writer.bytes_written
+            writer.end_element(devicesets, 3)
+        else:
+            writer.write_element(devicesets, 3)
+        self.spool.close()
+        writer.end_element(self.library.get_element(), 2)
+        writer.end_element(self.library_file.drawing, 1)
+        writer.end_element(self.library_file.eagle, 0)
+        writer.flush()
+
+    def get_bytes_written(self):
+        return self.writer.bytes_written
+
+
+# Read the packages and devicesets of an existing library file, yielding
+# EaglePackage and EagleDeviceset objects that wrap the parsed elements,
+# in file order (so all of the packages come first).  The file is parsed
+# incrementally, and each package or deviceset is dropped from the
+# document once it has been yielded, so only those the caller keeps are
+# held in memory.  Their contents are left as plain elements.
+def iter_library(infile):
+    parent = None
+    for event, element in iterparse(infile, events = ('start', 'end')):
+        if event == 'start':
+            if element.tag in ('packages', 'devicesets'):
+                parent = element
+        elif element.tag == 'package' and parent is not None and parent.tag == 'packages':
+            yield EaglePackage(None, from_element = element)
+            parent.remove(element)
+        elif element.tag == 'deviceset' and parent is not None and parent.tag == 'devicesets':
+            yield EagleDeviceset(None, from_element = element)
+            parent.remove(element)
+        elif element is parent:
+            parent = None
+
+
+# The offset just past the '>' that ends the tag starting at or after
+# offset start in a binary file, skipping any '>' in quoted attribute
+# values.
+def _tag_end(infile, start):
+    infile.seek(start)
+    position = start
+    quote = None
+    while True:
+        data = infile.read(4096)
+        if not data:
+            raise ValueError('unterminated tag at offset %d' % start)
+        for i, c in enumerate(data):
+            if quote is not None:
+                if c == quote:
+                    quote = None
+            elif c in b'"\'':
+                quote = c
+            elif c == 0x3e:  # '>'
+                return position + i + 1
+        position += len(data)
+
+
+# Find the packages and devicesets of a library (a seekable binary file)
+# without building elements for them, yielding ('package' or 'deviceset',
+# name, description, start, end) for each, in order, where start and end
+# are the byte offsets of the element in the file and description is the
+# text of a package's description (or None).  Elements found this way can
+# be copied from the file as they are (see EagleLibraryStream.add_raw()).
+# Since they are copied byte for byte, the file has to be UTF-8.
+def scan_library(infile, chunk_size = 1 << 20):
+    parser = expat.ParserCreate()
+    stack = []
+    found = []
+    current = None
+
+    def xml_decl(version, encoding, standalone):
+        if encoding is not None and encoding.lower() not in ('utf-8', 'utf8', 'us-ascii', 'ascii'):
+            raise ValueError('library encoding is %s, not UTF-8' % encoding)
+
+    def start(tag, attrs):
+        nonlocal current
+        stack.append(tag)
+        if current is None:
+            if (tag in ('package', 'deviceset') and len(stack) >= 3 and
+                stack[-2] == tag + 's' and stack[-3] == 'library'):
+                current = [tag, attrs.get('name'), parser.CurrentByteIndex, None, len(stack)]
+        elif tag == 'description' and len(stack) == current[4] + 1:
+            current.append(parser.CurrentByteIndex)
+
+    def end(tag):
+        nonlocal current
+        if current is not None:
+            if len(stack) == current[4]:
+                current[3] = parser.CurrentByteIndex
+                found.append(current)
+                current = None
+            elif tag == 'description' and len(stack) == current[4] + 1 and len(current) == 6:
+                current.append(parser.CurrentByteIndex)
+        stack.pop()
+
+    parser.XmlDeclHandler = xml_decl
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+
+    def finish(item):
+        kind, name, start, end_tag = item[:4]
+        # The end tag starts at end_tag, unless the element has no content
+        # and so no end tag, in which case that is where it starts.
+        end = _tag_end(infile, end_tag)
+        description = None
+        if len(item) == 7:
+            description_start, description_end_tag = item[5:]
+            description_end = _tag_end(infile, description_end_tag)
+            infile.seek(description_start)
+            data = infile.read(description_end - description_start)
+            description = fromstring(data).text
+        return kind, name, description, start, end
+
+    try:
+        position = 0
+        while True:
+            infile.seek(position)
+            data = infile.read(chunk_size)
+            position += len(data)
+            parser.Parse(data, not data)
+            if found:
+                items = found[:]
+                del found[:]
+                for item in items:
+                    yield finish(item)
+            if not data:
+                break
+    except expat.ExpatError as e:
+        raise ValueError(str(e)) from None
+
 
 '''
 class EagleBoard(EagleFile):
@@ -0,0 +1,685 @@
+#!/usr/bin/env python3
+
+# Render text labels into Eagle CAD packages
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple, deque, OrderedDict
+import csv
+import hashlib
+import itertools
+import json
+import os
+import re
+import time
+from xml.etree.ElementTree import fromstring
+
+from Eagle import EagleCompactPackage, EagleDeviceset, EagleDevice, EaglePolygon, EaglePackage, scan_library
+from Rasterize import RasterizeText, RasterSession, GlyphCache, raster_formats, check_threshold
+from Decompose import coalesce_runs, simplify_runs, rects_to_runs, trace_polygons
+
+
+# Everything needed to render one label.  size is in inches, resolution in
+# dpi, overlap in percent of a pixel.  threshold is the lowest pixel value
+# (out of 255) that counts as part of the text, which only matters for
+# antialiased rendering.  simplify, if given, is the tolerance for
+# Decompose.simplify_runs(), as a string: a number of pixels, optionally
+# with a 'px' suffix, or of millimetres with an 'mm' suffix.
+LabelSpec = namedtuple('LabelSpec', ['text', 'name', 'resolution', 'font', 'size',
+                                     'bold', 'italic', 'oblique',
+                                     'layer', 'halign', 'valign', 'overlap', 'polygon',
+                                     'antialias', 'threshold', 'simplify'],
+                       defaults = (False, 1, None))
+
+
+# Parse a simplify tolerance, returning (value, unit).
+def parse_tolerance(text):
+    text = str(text).strip().lower()
+    unit = 'px'
+    for suffix in ('px', 'mm'):
+        if text.endswith(suffix):
+            text = text[:-len(suffix)].strip()
+            unit = suffix
+    try:
+        value = float(text)
+    except ValueError:
+        raise ValueError('bad tolerance %r, must be a number of px or mm' % text) from None
+    if value < 0:
+        raise ValueError('tolerance must not be negative')
+    return value, unit
+
+
+# A label's simplify tolerance in whole pixels, or 0 for none.
+def tolerance_pixels(spec):
+    if not spec.simplify:
+        return 0
+    value, unit = parse_tolerance(spec.simplify)
+    if unit == 'mm':
+        value = value / 25.4 * spec.resolution
+    return int(value)
+
+
+def default_name(text):
+    return text.upper().replace(' ', '_')
+
+
+_field_types = { 'text':       str,
+                 'name':       str,
+                 'resolution': int,
+                 'font':       str,
+                 'size':       float,
+                 'bold':       bool,
+                 'italic':     bool,
+                 'oblique':    bool,
+                 'layer':      int,
+                 'halign':     str,
+                 'valign':     str,
+                 'overlap':    float,
+                 'polygon':    bool,
+                 'antialias':  bool,
+                 'threshold':  int,
+                 'simplify':   str }
+
+_field_choices = { 'halign': ('left', 'right', 'center'),
+                   'valign': ('top', 'bottom', 'baseline', 'center') }
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ('1', 'true', 'yes', 'y', 'on'):
+        return True
+    if value in ('', '0', 'false', 'no', 'n', 'off'):
+        return False
+    raise ValueError('bad boolean value %r' % value)
+
+
+# Make a LabelSpec from a manifest record (a dict of field name to value,
+# from CSV or JSON), filling in missing or empty fields from defaults.
+def spec_from_record(record, defaults):
+    if not isinstance(record, dict):
+        raise ValueError('record is not an object')
+    fields = { }
+    for key, value in record.items():
+        if key is None or value is None or value == '':
+            continue
+        key = key.strip()
+        if key not in _field_types:
+            raise ValueError('unknown field %r' % key)
+        field_type = _field_types[key]
+        if field_type is bool:
+            value = _parse_bool(value)
+        else:
+            value = field_type(value)
+        if key == 'simplify':
+            parse_tolerance(value)
+        if key == 'threshold':
+            check_threshold(value)
+        if key in _field_choices and value not in _field_choices[key]:
+            raise ValueError('bad %s %r, must be one of %s' % (key, value, ', '.join(_field_choices[key])))
+        fields[key] = value
+    if 'text' not in fields:
+        raise ValueError('record has no text')
+    if 'name' not in fields:
+        fields['name'] = default_name(fields['text'])
+    return defaults._replace(**fields)
+
+
+# Read label specs from a manifest, one record at a time, so that a manifest
+# of any length can be processed without holding it in memory.  The
+# manifest is either CSV with a header row naming the fields, or JSON
+# Lines with one object per line; format 'auto' decides from the first
+# non-blank line.  The field names are those of LabelSpec, and any that
+# are missing come from defaults.
+def read_manifest(infile, defaults, format = 'auto'):
+    lines = iter(infile)
+    if format == 'auto':
+        first = ''
+        for first in lines:
+            if first.strip():
+                break
+        if first.lstrip().startswith('{'):
+            format = 'jsonl'
+        else:
+            format = 'csv'
+        lines = itertools.chain([first], lines)
+
+    if format == 'jsonl':
+        records = ((line_number, json.loads(line))
+                   for line_number, line in enumerate(lines, 1) if line.strip())
+    else:
+        reader = csv.DictReader(lines, skipinitialspace = True)
+        records = ((reader.line_num, record) for record in reader)
+
+    for line_number, record in records:
+        try:
+            yield spec_from_record(record, defaults)
+        except ValueError as e:
+            raise ValueError('manifest line %d: %s' % (line_number, e)) from None
+
+
+# Everything in a LabelSpec except the name affects the package's
+# contents.  Each package's description holds a hash of these parameters
+# and render_version, followed by the parameters themselves as JSON:
+#   eagletext 3f0c...e9 {"antialias": false, "bold": false, ...}
+# so that when a library is updated, packages whose parameters haven't
+# changed can be copied rather than rendered again.
+def render_params(spec):
+    params = spec._asdict()
+    del params['name']
+    # Fields added since, while they have their default values, are left
+    # out, so that packages from before they were added stay up to date.
+    for field, default in _late_defaults.items():
+        if params[field] == default:
+            del params[field]
+    return params
+
+_late_defaults = { 'simplify': None }
+
+
+# The version of the rendering itself: run extraction, decomposition and
+# how packages are built from the results.  Increase it whenever a change
+# there alters the packages made from the same parameters, so that
+# packages in existing libraries, and cached renderings, are made again.
+render_version = 2
+
+
+def render_hash(spec):
+    params = json.dumps([render_version, render_params(spec)], sort_keys = True)
+    return hashlib.sha256(params.encode('utf-8')).hexdigest()
+
+
+# Labels with the same render parameters share one package, named after
+# the first of them, with a deviceset of their own that uses it.
+# LabelInterner.intern() returns the name of the package for each label as
+# it is reached, or None for a label given more than once after the first
+# time.  Only the render hashes of the labels seen so far are kept, so the
+# labels can be an arbitrarily long stream.  Two different labels with the
+# same name (e.g., "Vcc" and "VCC", whose default names are both VCC)
+# would otherwise overwrite each other, so the second raises ValueError.
+class LabelInterner:
+    def __init__(self):
+        self.hashes = { }
+        self.packages = { }
+
+    def intern(self, spec):
+        spec_hash = render_hash(spec)
+        if spec.name in self.hashes:
+            if self.hashes[spec.name] != spec_hash:
+                raise ValueError('label %r has the name %s, as does a different label before it' %
+                                 (spec.text, spec.name))
+            return None
+        self.hashes[spec.name] = spec_hash
+        return self.packages.setdefault(spec_hash, spec.name)
+
+
+# Yields (spec, package name) for each label in specs (an iterable of
+# LabelSpec), as LabelInterner.intern() gives, leaving out repeats.
+def intern_specs(specs):
+    interner = LabelInterner()
+    for spec in specs:
+        package_name = interner.intern(spec)
+        if package_name is not None:
+            yield spec, package_name
+
+
+def package_description(spec):
+    return 'eagletext %s %s' % (render_hash(spec), json.dumps(render_params(spec), sort_keys = True))
+
+
+_description_re = re.compile(r'eagletext ([0-9a-f]{64})\b')
+
+# The render hash stored in a package's description, or None.
+def package_render_hash(package):
+    match = _description_re.match(package.get_description() or '')
+    if match is None:
+        return None
+    return match.group(1)
+
+
+# A rough estimate, made without rendering, of the number of primitives in
+# a label's package: about one and a half rectangles for each pixel row of
+# each glyph, or two polygons for each glyph.  height_pixels is the height
+# of the text, if it has been measured, and otherwise taken to be the
+# font size.
+def estimate_primitives(spec, height_pixels = None):
+    glyphs = sum(1 for c in spec.text if not c.isspace())
+    if spec.polygon:
+        return 2 * glyphs
+    if height_pixels is None:
+        height_pixels = spec.size * spec.resolution
+    return int(1.5 * glyphs * height_pixels)
+
+
+# The LabelSpec that a package was built from, as recorded in its
+# description, or None if it has no eagletext description.
+def spec_from_package(package):
+    match = _description_re.match(package.get_description() or '')
+    if match is None:
+        return None
+    params = dict(_late_defaults)
+    try:
+        params.update(json.loads(package.get_description()[match.end():]))
+        return LabelSpec(name = package.name, **params)
+    except (TypeError, ValueError) as e:
+        raise ValueError('package %s: bad description: %s' % (package.name, e)) from None
+
+
+# A library being updated, read from infile (a seekable binary file, which
+# has to stay open until the new library has been written).  Only the
+# names, byte offsets and render hashes of its packages and devicesets are
+# kept: packages that are still up to date, and the packages and
+# devicesets of labels that aren't being built, are copied from the file
+# byte for byte rather than parsed.  If prune is true, the packages and
+# devicesets of other labels are dropped instead.
+class PreviousLibrary:
+    def __init__(self, infile, prune = False):
+        self.infile = infile
+        self.prune = prune
+        self.packages = OrderedDict()
+        self.devicesets = OrderedDict()
+        try:
+            for kind, name, description, start, end in scan_library(infile):
+                if kind == 'package':
+                    match = _description_re.match(description or '')
+                    self.packages[name] = (start, end, match and match.group(1))
+                else:
+                    self.devicesets[name] = (start, end)
+        except ValueError as e:
+            raise ValueError('%s: %s' % (getattr(infile, 'name', 'library'), e)) from None
+
+    # Whether the library's package for spec is up to date with it.
+    def is_current(self, spec):
+        entry = self.packages.get(spec.name)
+        return entry is not None and entry[2] == render_hash(spec)
+
+    def read(self, kind, name):
+        if kind == 'package':
+            start, end, _ = self.packages[name]
+        else:
+            start, end = self.devicesets[name]
+        self.infile.seek(start)
+        return self.infile.read(end - start)
+
+    # The package or deviceset, parsed, for building a library in memory.
+    def parse(self, kind, name):
+        element = fromstring(self.read(kind, name))
+        if kind == 'package':
+            return EaglePackage(None, from_element = element)
+        return EagleDeviceset(None, from_element = element)
+
+    # The names of the packages and the devicesets that aren't in names
+    # (the names of the labels being built), as (kind, name) pairs.
+    def others(self, names):
+        if self.prune:
+            return []
+        return ([('package', name) for name in self.packages if name not in names] +
+                [('deviceset', name) for name in self.devicesets if name not in names])
+
+
+# The result of rendering a label, in pixels: either rects, a flat array of
+# (x1, row1, x2, row2) rectangles, or polygons, a list of vertex lists, as
+# returned by Decompose.  Unlike the package built from it, this is small
+# and cheap to pickle.  error is the deviation, in pixels, of a simplified
+# label from its rendering (see Decompose.simplify_runs()), or None if it
+# wasn't simplified.  seconds is the wall time taken by each stage of
+# rendering: 'rasterize' (measuring and drawing the text, including any
+# strips or cached glyphs), 'runs' (extracting runs from the drawn pixels)
+# and 'decompose'.
+RenderedLabel = namedtuple('RenderedLabel', ['width_pixels', 'height_pixels', 'origin',
+                                             'run_count', 'rects', 'removed', 'polygons',
+                                             'error', 'seconds'],
+                           defaults = (None, None))
+
+
+def rasterize_label(spec, session = None, debug_png = None, strip_height = None):
+    return RasterizeText(spec.text, spec.resolution, spec.font, spec.size,
+                         spec.bold, spec.italic, spec.oblique, spec.antialias,
+                         session = session, debug_png = debug_png,
+                         threshold = spec.threshold, strip_height = strip_height)
+
+
+def render_label(spec, session = None, debug_png = None, strip_height = None):
+    start = time.perf_counter()
+    extracted = session.extract_seconds if session is not None else 0.0
+    raster = rasterize_label(spec, session, debug_png, strip_height)
+    width_pixels, height_pixels = raster.get_size_pixels()
+    rasterized = time.perf_counter()
+
+    # Runs come back bottom row first, matching increasing Eagle y.  They
+    # are consumed as they are produced, so when rendering in strips only
+    # one strip's worth of pixels exists at a time.  Drawing and extracting
+    # happen both while rasterizing and while getting the runs (depending
+    # on how the text is rendered), so the session's own count of time
+    # spent extracting is what tells them apart.
+    run_count = 0
+    run_seconds = 0.0
+    def runs():
+        nonlocal run_count, run_seconds
+        strips = raster.iter_run_strips()
+        while True:
+            t = time.perf_counter()
+            strip = next(strips, None)
+            run_seconds += time.perf_counter() - t
+            if strip is None:
+                return
+            run_count += len(strip) // 3
+            yield from strip
+
+    rects = None
+    removed = 0
+    polygons = None
+    error = None
+    tolerance = tolerance_pixels(spec)
+    if tolerance:
+        rects, removed, error = simplify_runs(runs(), tolerance)
+        if spec.polygon:
+            polygons = trace_polygons(rects_to_runs(rects))
+            rects = None
+    elif spec.polygon:
+        polygons = trace_polygons(runs())
+    else:
+        rects, removed = coalesce_runs(runs())
+    extracted = raster.session.extract_seconds - extracted
+    seconds = { 'rasterize': rasterized - start + run_seconds - extracted,
+                'runs':      extracted,
+                'decompose': time.perf_counter() - rasterized - run_seconds }
+    return RenderedLabel(width_pixels, height_pixels, raster.get_origin(),
+                         run_count, rects, removed, polygons, error, seconds)
+
+
+# Raise ValueError for LabelRenderer options that don't make sense, before
+# anything is rendered (or any worker processes are started).  Only whole
+# rasters can be written as debug PNGs.
+def check_renderer_options(glyph_cache_size = 0, debug_png_dir = None, strip_height = None,
+                           **others):
+    if strip_height is not None and strip_height <= 0:
+        raise ValueError('strip height must be positive, not %d' % strip_height)
+    if debug_png_dir is not None and (glyph_cache_size > 0 or strip_height):
+        raise ValueError("debug PNGs can't be written when using the glyph cache or rendering in strips")
+
+
+# Renders labels, keeping a RasterSession for each of the most recently
+# used fonts so that labels in the same font share their Cairo state, and
+# one glyph cache (if glyph_cache_size > 0) for all of them, apart from
+# antialiased labels, which are always rendered whole (see RasterSession).  If
+# debug_png_dir is given, each label's raster is written there as
+# <name>.png.  raster_format is a key of Rasterize.raster_formats.  If
+# strip_height is given, labels are rendered that many rows at a time.
+class LabelRenderer:
+    def __init__(self, glyph_cache_size = 0, max_sessions = 16, debug_png_dir = None,
+                 raster_format = 'rgb24', strip_height = None):
+        check_renderer_options(glyph_cache_size, debug_png_dir, strip_height)
+        self.format = raster_formats[raster_format]
+        self.strip_height = strip_height
+        self.glyph_cache = None
+        if glyph_cache_size > 0:
+            self.glyph_cache = GlyphCache(glyph_cache_size)
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.debug_png_dir = debug_png_dir
+
+    def get_session(self, spec):
+        key = (spec.resolution, spec.font, spec.size, spec.bold, spec.italic, spec.oblique,
+               spec.antialias, spec.threshold)
+        session = self.sessions.get(key)
+        if session is None:
+            session = RasterSession(spec.resolution, spec.font, spec.size,
+                                    spec.bold, spec.italic, spec.oblique,
+                                    spec.antialias,
+                                    None if spec.antialias else self.glyph_cache,
+                                    self.format, spec.threshold)
+            self.sessions[key] = session
+            if len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last = False)
+        else:
+            self.sessions.move_to_end(key)
+        return session
+
+    def render(self, spec):
+        debug_png = None
+        if self.debug_png_dir is not None:
+            debug_png = os.path.join(self.debug_png_dir, spec.name + '.png')
+        return render_label(spec, self.get_session(spec), debug_png, self.strip_height)
+
+
+# Offsets, in inches, to subtract from the label's coordinates to put its
+# origin where the alignment asks for it.
+def alignment_offsets(spec, width_pixels, height_pixels, origin):
+    x_origin, y_origin = origin
+
+    yoffset = 0
+    if spec.valign == 'top':
+        yoffset = height_pixels/spec.resolution
+    elif spec.valign == 'bottom':
+        pass
+    elif spec.valign == 'baseline':
+        yoffset = height_pixels/spec.resolution - y_origin
+    elif spec.valign == 'center':
+        yoffset = height_pixels/(2*spec.resolution)
+    #elif spec.valign == 'center-above-baseline':
+    #    yoffset = ?
+
+    xoffset = 0
+    if spec.halign == 'left':
+        pass
+    elif spec.halign == 'right':
+        xoffset = width_pixels/spec.resolution
+    elif spec.halign == 'center':
+        xoffset = width_pixels/(2*spec.resolution)
+
+    return xoffset, yoffset
+
+
+# Maps pixel coordinates to the text of Eagle coordinates, converting each
+# one only when it is first looked up.
+class _CoordinateText(dict):
+    def __init__(self, convert):
+        self.convert = convert
+
+    def __missing__(self, p):
+        text = self[p] = '%.6f' % self.convert(p)
+        return text
+
+
+def build_package(spec, rendered):
+    resolution = spec.resolution
+    height_pixels = rendered.height_pixels
+    xoffset, yoffset = alignment_offsets(spec, rendered.width_pixels, height_pixels, rendered.origin)
+    overlap = spec.overlap/(200 * resolution)
+
+    package = EagleCompactPackage(spec.name)
+    package.set_description(package_description(spec))
+
+    if rendered.polygons is not None:
+        for polygon in rendered.polygons:
+            vertices = [((xp / resolution - xoffset) * 25.4,
+                         ((height_pixels - yp) / resolution - yoffset) * 25.4)
+                        for xp, yp in polygon]
+            package.add_primitive(EaglePolygon(spec.layer, vertices))
+    else:
+        # Every rectangle's edges are on the pixel grid, so the text of
+        # each y coordinate is worked out once per row, and of each x
+        # coordinate once per distinct x.  The arithmetic is the same as
+        # converting each rectangle on its own, so the text is too.
+        y1_text = ['%.6f' % (((height_pixels - row) / resolution - overlap - yoffset) * 25.4)
+                   for row in range(height_pixels + 1)]
+        y2_text = ['%.6f' % (((height_pixels - row) / resolution + overlap - yoffset) * 25.4)
+                   for row in range(height_pixels + 1)]
+        x_text = _CoordinateText(lambda xp: (xp / resolution - xoffset) * 25.4)
+        package.add_pixel_rectangles(spec.layer, rendered.rects, x_text, y1_text, y2_text)
+
+    return package
+
+
+def build_deviceset(spec, package_name = None):
+    deviceset = EagleDeviceset(spec.name)
+    deviceset.add_device(EagleDevice('', package_name or spec.name))
+    return deviceset
+
+
+def describe(spec, rendered):
+    if rendered.polygons is not None:
+        text = '%s: %d runs, %d polygons, %d vertices' % (spec.name, rendered.run_count, len(rendered.polygons),
+                                                          sum(len(p) for p in rendered.polygons))
+    else:
+        text = '%s: %d runs, %d rectangles (%d merged away)' % (spec.name, rendered.run_count,
+                                                               len(rendered.rects) // 4, rendered.removed)
+    if rendered.error is not None:
+        text += ', error %d px (%.4f mm)' % (rendered.error, rendered.error / spec.resolution * 25.4)
+    return text
+
+
+# The size and placement of a label, as worked out from the font's text
+# extents without rendering it.  Lengths are in millimetres, apart from
+# the size of the label's raster in pixels, which is what rendering would
+# give.  The bearings and advance are as Cairo reports them: the offset
+# from the text's origin (on its baseline) to the top left of its ink,
+# and to where following text would start.  xoffset and yoffset are where
+# the package's origin is, from the bottom left corner of the label, as
+# set by halign and valign; primitives is estimate_primitives().
+LabelMetrics = namedtuple('LabelMetrics', ['name', 'text', 'width_pixels', 'height_pixels',
+                                           'width', 'height', 'x_bearing', 'y_bearing',
+                                           'x_advance', 'xoffset', 'yoffset', 'primitives'])
+
+
+# Measures labels without rendering them.  Fonts are loaded through
+# renderer (a LabelRenderer, by default a new one), whose sessions only
+# need their 1x1 measuring context for this, and the extents of up to
+# max_extents strings are kept, keyed by everything that affects them.
+class LabelMeasurer:
+    def __init__(self, renderer = None, max_extents = 65536):
+        self.renderer = renderer or LabelRenderer()
+        self.max_extents = max_extents
+        self.extents = OrderedDict()
+
+    def get_extents(self, spec):
+        key = (spec.resolution, spec.font, spec.size, spec.bold, spec.italic, spec.oblique,
+               spec.antialias, spec.text)
+        extents = self.extents.get(key)
+        if extents is None:
+            extents = self.renderer.get_session(spec).measure(spec.text)
+            self.extents[key] = extents
+            if len(self.extents) > self.max_extents:
+                self.extents.popitem(last = False)
+        else:
+            self.extents.move_to_end(key)
+        return extents
+
+    # The same arithmetic as RasterizeText and build_package().
+    def measure(self, spec):
+        x_bearing, y_bearing, width, height, x_advance, y_advance = self.get_extents(spec)
+        width_pixels = int(width * spec.resolution)
+        height_pixels = int(height * spec.resolution)
+        xoffset, yoffset = alignment_offsets(spec, width_pixels, height_pixels,
+                                             (-x_bearing, -y_bearing))
+        return LabelMetrics(spec.name, spec.text, width_pixels, height_pixels,
+                            width_pixels / spec.resolution * 25.4,
+                            height_pixels / spec.resolution * 25.4,
+                            x_bearing * 25.4, y_bearing * 25.4, x_advance * 25.4,
+                            xoffset * 25.4, yoffset * 25.4,
+                            estimate_primitives(spec, height_pixels))
+
+
+# Each worker process keeps its own renderer: a process pool rendering
+# labels is made with initializer = init_worker and initargs =
+# (renderer_options,), and renders a label with render_in_worker(spec).
+_worker_renderer = None
+
+def init_worker(renderer_options):
+    global _worker_renderer
+    _worker_renderer = LabelRenderer(**renderer_options)
+
+def render_in_worker(spec):
+    return _worker_renderer.render(spec)
+
+
+# The parameters that affect a label's rendering, as opposed to how the
+# package is built from it, for keying the render cache.
+def raster_params(spec, renderer_options):
+    return { 'version':       render_version,
+             'text':          spec.text,
+             'resolution':    spec.resolution,
+             'font':          spec.font,
+             'size':          spec.size,
+             'bold':          spec.bold,
+             'italic':        spec.italic,
+             'oblique':       spec.oblique,
+             'polygon':       spec.polygon,
+             'antialias':     spec.antialias,
+             'threshold':     spec.threshold,
+             'simplify':      tolerance_pixels(spec),
+             'raster_format': renderer_options.get('raster_format', 'rgb24'),
+             'glyph_cache':   renderer_options.get('glyph_cache_size', 0) > 0 }
+
+
+# Render a sequence of labels, yielding (spec, rendered) pairs in the same
+# order as specs.  With jobs > 1 the labels are rendered in that many
+# worker processes, and only the compact RenderedLabel data comes back, so
+# the packages built from the results are the same as for a serial run.
+# If cache (a Cache.RenderCache) is given, labels found in it aren't
+# rendered at all, and those that are rendered are added to it.  A serial
+# run uses renderer if one is given, and otherwise makes a LabelRenderer
+# with the other keyword arguments, as does each worker process.
+def render_labels(specs, jobs = 1, cache = None, renderer = None, **renderer_options):
+    def lookup(spec):
+        if cache is None:
+            return None, None
+        start = time.perf_counter()
+        key = cache.key(raster_params(spec, renderer_options))
+        fields = cache.get(key)
+        if fields is None:
+            return key, None
+        return key, RenderedLabel(*fields, seconds = { 'cache': time.perf_counter() - start })
+
+    def store(key, rendered):
+        if key is not None:
+            cache.put(key, rendered)
+        return rendered
+
+    if jobs <= 1:
+        if renderer is None:
+            renderer = LabelRenderer(**renderer_options)
+        for spec in specs:
+            key, rendered = lookup(spec)
+            if rendered is None:
+                rendered = store(key, renderer.render(spec))
+            yield spec, rendered
+        return
+
+    # Keep a few labels per worker in flight, but don't read ahead any
+    # further than that, so specs can be an arbitrarily long stream.
+    def finish(spec, key, rendered, future):
+        if rendered is None:
+            rendered = store(key, future.result())
+        return spec, rendered
+
+    check_renderer_options(**renderer_options)
+    from concurrent.futures import ProcessPoolExecutor
+    window = jobs * 4
+    pending = deque()
+    with ProcessPoolExecutor(max_workers = jobs,
+                             initializer = init_worker,
+                             initargs = (renderer_options,)) as executor:
+        for spec in specs:
+            key, rendered = lookup(spec)
+            future = None
+            if rendered is None:
+                future = executor.submit(render_in_worker, spec)
+            pending.append((spec, key, rendered, future))
+            if len(pending) >= window:
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
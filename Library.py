@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# Generate Eagle CAD libraries of rasterized text
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The library API behind eagletext.py:
+#   from Label import LabelSpec
+#   from Library import generate_library
+#   spec = LabelSpec('R1', 'R1', 600, 'sans', 0.2, False, False, False,
+#                    21, 'left', 'bottom', 10.0, False)
+#   lib = generate_library([spec])          # an EagleLibraryFile
+#   generate_library([spec], 'labels.lbr')  # or written as it is built
+# Nothing here imports cairocffi until a label is actually rendered.
+
+import itertools
+import os
+import time
+
+from Eagle import EagleLibraryFile
+from Label import intern_specs, render_labels, build_package, build_deviceset, describe
+
+
+# Write a file by calling write with it open (in mode), to a temporary
+# file beside path that is moved into place once it is complete, and
+# return what write returned.  Unlike tempfile's files, the temporary file
+# is created with the usual permissions.
+def write_replacing(path, mode, write):
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(temp, mode) as f:
+            result = write(f)
+    except BaseException:
+        try:
+            os.unlink(temp)
+        except FileNotFoundError:
+            pass
+        raise
+    os.replace(temp, path)
+    return result
+
+
+# Render the labels in specs (an iterable of Label.LabelSpec) and build a
+# library of them, with a deviceset for each, in order.  Labels that differ
+# only in name share one package, rendered once (see Label.intern_specs(),
+# which also rejects clashing names).  If outfile (a binary or text file,
+# or a file name) is given, the library is written to it as it is built,
+# so only the few labels between the renderer and the writer are held in
+# memory at a time, and the number of bytes written is returned;
+# otherwise the EagleLibraryFile is returned.  A file name is written by
+# write_replacing(), so that it is left alone if the build fails part way.
+#
+# jobs, cache and renderer are as for Label.render_labels(), and any other
+# keyword arguments are passed on to it for Label.LabelRenderer.  previous
+# is the Label.PreviousLibrary of a library being updated: packages that
+# are still up to date are copied from it rather than rendered, and the
+# packages and devicesets of other labels in it are added at the end.
+# stats, if given, is a Stats.BuildStats to record the build in.  If log
+# is given, a line describing each label is printed to it.
+def generate_library(specs, outfile = None, jobs = 1, cache = None, renderer = None,
+                     previous = None, stats = None, log = None, **renderer_options):
+    if isinstance(outfile, str):
+        return write_replacing(outfile, 'wb',
+                               lambda f: generate_library(specs, f, jobs, cache, renderer, previous,
+                                                          stats, log, **renderer_options))
+
+    def is_current(spec):
+        return previous is not None and previous.is_current(spec)
+    # Only the labels with packages of their own that can't be copied from
+    # the previous library are rendered, but all are written in the order
+    # given.  The renderer reads a little ahead of the writer, so the labels
+    # in between are held until the writer gets to them.
+    to_render, to_write = itertools.tee(intern_specs(specs))
+    rendered_labels = render_labels((spec for spec, package_name in to_render
+                                     if package_name == spec.name and not is_current(spec)),
+                                    jobs, cache, renderer, **renderer_options)
+    def labels():
+        for spec, package_name in to_write:
+            if package_name != spec.name or is_current(spec):
+                yield spec, package_name, None
+            else:
+                yield spec, package_name, next(rendered_labels)[1]
+    names = set()
+
+    lib = EagleLibraryFile()
+    if outfile is None:
+        # Nothing is written, so stats records no bytes or write times.
+        for spec, package_name, rendered in labels():
+            names.add(spec.name)
+            if package_name != spec.name:
+                if log is not None:
+                    print('%s: shares package %s' % (spec.name, package_name), file = log)
+                lib.add_deviceset(build_deviceset(spec, package_name))
+                if stats is not None:
+                    stats.add_shared(spec, package_name, None)
+                continue
+            if rendered is None:
+                if log is not None:
+                    print('%s: unchanged' % spec.name, file = log)
+                lib.add_package(previous.parse('package', spec.name))
+                lib.add_deviceset(build_deviceset(spec))
+                if stats is not None:
+                    stats.add_reused(spec, None)
+                continue
+            if log is not None:
+                print(describe(spec, rendered), file = log)
+            start = time.perf_counter()
+            lib.add_package(build_package(spec, rendered))
+            lib.add_deviceset(build_deviceset(spec))
+            if stats is not None:
+                stats.add_label(spec, rendered, time.perf_counter() - start, 0.0, None)
+        if previous is not None:
+            for kind, name in previous.others(names):
+                if kind == 'package':
+                    lib.add_package(previous.parse(kind, name))
+                else:
+                    lib.add_deviceset(previous.parse(kind, name))
+        if stats is not None:
+            stats.finish(None)
+        return lib
+
+    with lib.stream(outfile) as stream:
+        for spec, package_name, rendered in labels():
+            names.add(spec.name)
+            if package_name != spec.name:
+                if log is not None:
+                    print('%s: shares package %s' % (spec.name, package_name), file = log)
+                size = stream.add_deviceset(build_deviceset(spec, package_name))
+                if stats is not None:
+                    stats.add_shared(spec, package_name, size)
+                continue
+            if rendered is None:
+                if log is not None:
+                    print('%s: unchanged' % spec.name, file = log)
+                size = (stream.add_raw('package', previous.read('package', spec.name)) +
+                        stream.add_deviceset(build_deviceset(spec)))
+                if stats is not None:
+                    stats.add_reused(spec, size)
+                continue
+            if log is not None:
+                print(describe(spec, rendered), file = log)
+            start = time.perf_counter()
+            package = build_package(spec, rendered)
+            deviceset = build_deviceset(spec)
+            built = time.perf_counter()
+            size = stream.add_package(package) + stream.add_deviceset(deviceset)
+            if stats is not None:
+                stats.add_label(spec, rendered, built - start, time.perf_counter() - built, size)
+        if previous is not None:
+            for kind, name in previous.others(names):
+                stream.add_raw(kind, previous.read(kind, name))
+
+    if stats is not None:
+        stats.finish(stream.get_bytes_written())
+    return stream.get_bytes_written()
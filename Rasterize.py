@@ -16,18 +16,298 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import array
-import cairocffi
+from collections import OrderedDict
+from itertools import groupby
+import math
+from operator import itemgetter
+import re
+import sys
+import time
 
 
+# cairocffi, and numpy if it is installed, take a large fraction of a
+# second to import, so they aren't imported until something is rendered
+# (see _import_cairocffi() and _import_numpy()).  These are Cairo's
+# values for the surface formats, which never change.
+FORMAT_ARGB32 = 0
+FORMAT_RGB24 = 1
+FORMAT_A8 = 2
+FORMAT_A1 = 3
+FORMAT_RGB16_565 = 4
+FORMAT_RGB30 = 5
+
+cairocffi = None
+numpy = None
+_numpy_imported = False
+
+def _import_cairocffi():
+    global cairocffi
+    if cairocffi is None:
+        import cairocffi as module
+        cairocffi = module
+    return cairocffi
+
+def _import_numpy():
+    global numpy, _numpy_imported
+    if not _numpy_imported:
+        try:
+            import numpy as module
+            numpy = module
+        except ImportError:
+            pass
+        _numpy_imported = True
+    return numpy
+
+
+_bits_per_pixel = { FORMAT_ARGB32:    32,
+                    FORMAT_RGB24:     32,
+                    FORMAT_A8:        8,
+                    FORMAT_A1:        1,
+                    FORMAT_RGB16_565: 16,
+                    FORMAT_RGB30:     32 }
+
+# Names for the surface formats that text can be rendered into.  RGB24
+# uses 32 bits per pixel, A8 8 bits and A1 a single bit, so for large
+# labels at high resolution A8 and A1 need far less memory.
+raster_formats = { 'rgb24': FORMAT_RGB24,
+                   'a8':    FORMAT_A8,
+                   'a1':    FORMAT_A1 }
+
+_on_pixels = re.compile(b'[^\\x00]+')
+
+def _on_pixels_for(threshold):
+    if threshold <= 1:
+        return _on_pixels
+    return re.compile(b'[' + re.escape(bytes([threshold])) + b'-\\xff]+')
+
+
+# A pixel value threshold has to be one that some pixel values can reach,
+# and that some can't.
+def check_threshold(threshold):
+    if not 1 <= threshold <= 255:
+        raise ValueError('threshold must be from 1 to 255, not %d' % threshold)
+
+# Cairo packs A1 pixels into 32-bit words with the first pixel in the
+# least significant bit on little-endian hosts and in the most significant
+# bit on big-endian hosts, which works out to the same order within each
+# byte.  For each byte value, list the runs of set pixels within it.
+_a1_lsb_first = sys.byteorder == 'little'
+
+def _byte_runs(b):
+    if _a1_lsb_first:
+        bits = [(b >> i) & 1 for i in range(8)]
+    else:
+        bits = [(b >> (7 - i)) & 1 for i in range(8)]
+    runs = []
+    for i, bit in enumerate(bits):
+        if bit:
+            if runs and runs[-1][1] == i:
+                runs[-1] = (runs[-1][0], i + 1)
+            else:
+                runs.append((i, i + 1))
+    return runs
+
+_a1_byte_runs = [_byte_runs(b) for b in range(256)]
+
+
+# Extract all of the "on" pixel runs of a surface in a single pass.
+# The result is a flat array('i') of (row, x1, x2) triples, with x2
+# exclusive.  A pixel is "on" if the first byte of its data is at least
+# threshold; the default of 1 (nonzero) is the test eagletext.py has always
+# applied to RasterRowIterator output.  For A1 surfaces a pixel is on if
+# its bit is set.  Unlike RasterRowIterator, adjacent "on" pixels with
+# different values are merged into one run, which makes no difference for
+# the non-antialiased rendering that RasterizeText does by default.
+#
+# Rows are in surface order (top to bottom) unless bottom_up is true, in
+# which case they are emitted bottom to top, the order in which Eagle
+# coordinates increase.  Row numbers are always surface row numbers.
+# width and height restrict extraction to the top left corner of the
+# surface.
+def extract_runs(surface, bottom_up = False, width = None, height = None, threshold = 1):
+    surface.flush()
+    bits_per_pixel = _bits_per_pixel[surface.get_format()]
+    data = surface.get_data()
+    stride = surface.get_stride()
+    if width is None:
+        width = surface.get_width()
+    if height is None:
+        height = surface.get_height()
+    check_threshold(threshold)
+    if _import_numpy() is not None:
+        return _extract_runs_numpy(data, stride, width, height, bits_per_pixel, bottom_up, threshold)
+    return _extract_runs_python(data, stride, width, height, bits_per_pixel, bottom_up, threshold)
+
+
+# The numpy extraction works on blocks of rows of about this many pixels,
+# so that its temporary arrays (a few bytes per pixel) stay small however
+# big the surface is; otherwise they would outweigh an A1 or A8 surface.
+_block_pixels = 1 << 20
+
+def _extract_runs_numpy(data, stride, width, height, bits_per_pixel, bottom_up, threshold):
+    runs = array.array('i')
+    if width == 0 or height == 0:
+        return runs
+    pixels = numpy.frombuffer(data, dtype = numpy.uint8, count = stride * height)
+    pixels = pixels.reshape(height, stride)
+    block_rows = max(_block_pixels // (width + 2), 1)
+    tops = range(0, height, block_rows)
+    if bottom_up:
+        tops = reversed(tops)
+    for top in tops:
+        bottom = min(top + block_rows, height)
+        block = pixels[top:bottom]
+        if bits_per_pixel == 1:
+            bitorder = 'little' if _a1_lsb_first else 'big'
+            on = numpy.unpackbits(block[:, :(width + 7) // 8], axis = 1, bitorder = bitorder)[:, :width]
+        else:
+            b = bits_per_pixel // 8
+            on = block[:, 0:width * b:b] >= threshold
+        if bottom_up:
+            on = on[::-1]
+
+        # Pad each row with an "off" pixel at both ends, so that every run
+        # has both a rising and a falling edge within the row.
+        padded = numpy.zeros((bottom - top, width + 2), dtype = numpy.int8)
+        padded[:, 1:-1] = on
+        edges = numpy.diff(padded, axis = 1)
+        rows, x1 = numpy.nonzero(edges == 1)
+        x2 = numpy.nonzero(edges == -1)[1]
+        if bottom_up:
+            rows = bottom - 1 - rows
+        else:
+            rows = rows + top
+
+        triples = numpy.empty((len(rows), 3), dtype = numpy.int32)
+        triples[:, 0] = rows
+        triples[:, 1] = x1
+        triples[:, 2] = x2
+        runs.frombytes(triples.tobytes())
+    return runs
+
+
+# Find the runs of one row of an A1 surface without looking at each pixel:
+# the regular expression skips over bytes with no pixels set, and a byte
+# with all pixels set just extends the current run.
+def _extract_a1_row(runs, row, y, width):
+    start = None
+    end = None
+    for m in _on_pixels.finditer(row):
+        for i in range(m.start(), m.end()):
+            base = i * 8
+            for x1, x2 in _a1_byte_runs[row[i]]:
+                if end == base + x1:
+                    end = base + x2
+                else:
+                    if start is not None and start < width:
+                        runs.extend((y, start, min(end, width)))
+                    start = base + x1
+                    end = base + x2
+    if start is not None and start < width:
+        runs.extend((y, start, min(end, width)))
+
+
+def _extract_runs_python(data, stride, width, height, bits_per_pixel, bottom_up, threshold):
+    runs = array.array('i')
+    on_pixels = _on_pixels_for(threshold)
+    if bottom_up:
+        rows = range(height - 1, -1, -1)
+    else:
+        rows = range(height)
+    for y in rows:
+        base = y * stride
+        if bits_per_pixel == 1:
+            _extract_a1_row(runs, data[base:base + (width + 7) // 8], y, width)
+            continue
+        b = bits_per_pixel // 8
+        row = data[base:base + width * b][::b]
+        for m in on_pixels.finditer(row):
+            runs.extend((y, m.start(), m.end()))
+    return runs
+
+
+# Reverse the row order of runs (top to bottom <-> bottom to top), keeping
+# the runs within each row in order.
+def reverse_rows(runs):
+    rows = []
+    it = iter(runs)
+    for row, group in groupby(zip(it, it, it), key = itemgetter(0)):
+        rows.append(list(group))
+    result = array.array('i')
+    for group in reversed(rows):
+        for triple in group:
+            result.extend(triple)
+    return result
+
+
+# Combine runs from several sources into the runs of a width x height
+# surface.  pieces is a sequence of (runs, dx, dy), each runs array being
+# offset by dx, dy; runs outside the surface are clipped, and overlapping
+# or touching runs are merged, so the result is what extract_runs() would
+# return for a surface on which all of the pieces had been drawn.
+def compose_runs(pieces, width, height, bottom_up = False):
+    spans_by_row = { }
+    for runs, dx, dy in pieces:
+        it = iter(runs)
+        for row, x1, x2 in zip(it, it, it):
+            row += dy
+            if 0 <= row < height:
+                x1 = max(x1 + dx, 0)
+                x2 = min(x2 + dx, width)
+                if x1 < x2:
+                    spans_by_row.setdefault(row, []).append((x1, x2))
+
+    result = array.array('i')
+    for row in sorted(spans_by_row, reverse = bottom_up):
+        spans = sorted(spans_by_row[row])
+        run_x1, run_x2 = spans[0]
+        for x1, x2 in spans[1:]:
+            if x1 <= run_x2:
+                run_x2 = max(run_x2, x2)
+            else:
+                result.extend((row, run_x1, run_x2))
+                run_x1, run_x2 = x1, x2
+        result.extend((row, run_x1, run_x2))
+    return result
+
+
+# Least recently used cache of rendered glyphs, shared between
+# RasterizeText instances.  Each entry holds the runs of one glyph,
+# relative to the integer part of its device position.  Cairo positions
+# glyphs with subpixel precision, so the fractional part of the position
+# is part of the key; with metrics hinting (the default) that is the same
+# for every glyph in a string.
+class GlyphCache:
+    def __init__(self, max_glyphs = 4096):
+        self.max_glyphs = max_glyphs
+        self.glyphs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.glyphs)
+
+    def get(self, key, render):
+        try:
+            runs = self.glyphs[key]
+        except KeyError:
+            self.misses += 1
+            runs = render()
+            self.glyphs[key] = runs
+            if len(self.glyphs) > self.max_glyphs:
+                self.glyphs.popitem(last = False)
+        else:
+            self.hits += 1
+            self.glyphs.move_to_end(key)
+        return runs
+
+    def clear(self):
+        self.glyphs.clear()
+
 
 class RasterRowIterator:
     def __init__(self, surface, y):
-        self.bits_per_pixel = { cairocffi.FORMAT_ARGB32:    32,
-                                cairocffi.FORMAT_RGB24:     32,
-                                cairocffi.FORMAT_A8:        8,
-                                cairocffi.FORMAT_A1:        1,
-                                cairocffi.FORMAT_RGB16_565: 16,
-                                cairocffi.FORMAT_RGB30:     32 }[surface.get_format()]
+        self.bits_per_pixel = _bits_per_pixel[surface.get_format()]
         self.row_base = y * surface.get_stride()
         self.data = surface.get_data()
         self.width = surface.get_width()
@@ -48,7 +328,7 @@ class RasterRowIterator:
             return self.data[i:i+b]
         elif self.bits_per_pixel == 1:
             i = self.row_base + x // 8
-            return (self.data[i] >> (x % 8)) & 1
+            return (self.data[i] >> (x % 8 if _a1_lsb_first else 7 - x % 8)) & 1
 
     def next(self):
         if self.x >= self.width:
@@ -68,39 +348,30 @@ class RasterRowIterator:
                 return result
 
         
-class RasterizeText:
-    # width, height in pixels
-    # default 1x1 pixel for a dummy surface to get text extents before
-    # allocating the real surface
-    def _setup_context(self, width = 1, height = 1):
-        self.surface = cairocffi.ImageSurface(cairocffi.FORMAT_RGB24, width, height)
-        self.context = cairocffi.Context(self.surface)
-        self.context.scale(self.resolution, self.resolution)
-        self.context.set_source_rgb(0, 0, 0) # black
-        self.context.paint
-        self.context.set_source_rgb(1, 1, 1) # white
-
-        if not self.antialias:
-            font_options = self.surface.get_font_options()
-            font_options.set_antialias(cairocffi.ANTIALIAS_NONE)
-            self.context.set_font_options(font_options)
-            
-        self.context.select_font_face(self.face, self.slant, self.weight)
-
-        self.context.set_font_size(self.size)
-
-        self.surface_data = self.surface.get_data()
-        self.surface_stride = self.surface.get_stride()
-    
-
+# Rendering state for one font at one resolution, kept between strings:
+# a 1x1 context for measuring, and a scratch surface, reused for each
+# string or glyph and only reallocated when something bigger comes along.
+# Runs are extracted as soon as something is drawn, since the next
+# render overwrites the surface; extract_seconds adds up the time spent
+# extracting them, which can't otherwise be told apart from drawing when
+# the two are interleaved (in strips or glyph by glyph).  format is one of raster_formats; A8 and
+# A1 surfaces take a quarter and a thirty-second of the memory of RGB24.
+# Antialiased text can't be composed from cached glyphs: thresholding each
+# glyph on its own gives different edge pixels where glyphs overlap than
+# thresholding the whole string does.
+class RasterSession:
     def __init__(self,
-                 text,        # text to render
                  resolution,  # resolution in dpi
                  face,
                  size,        # size in inches
                  bold, italic, oblique,
-                 antialias = False):
-        self.text = text
+                 antialias = False,
+                 glyph_cache = None,   # GlyphCache to compose text from
+                 format = FORMAT_RGB24,
+                 threshold = 1):       # lowest pixel value that counts as on
+        if antialias and glyph_cache is not None:
+            raise ValueError("antialiased text can't be composed from cached glyphs")
+        _import_cairocffi()
         self.resolution = resolution
         self.face = face
         self.size = size
@@ -115,29 +386,245 @@ class RasterizeText:
         else:
             self.weight = cairocffi.FONT_WEIGHT_NORMAL
         self.antialias = antialias
+        self.glyph_cache = glyph_cache
+        self.format = format
+        check_threshold(threshold)
+        self.threshold = threshold
+
+        self.font_face = cairocffi.ToyFontFace(self.face, self.slant, self.weight)
+        self.measure_surface = cairocffi.ImageSurface(self.format, 1, 1)
+        self.measure_context = self._new_context(self.measure_surface)
+        self.scaled_font = self.measure_context.get_scaled_font()
+
+        self.surface = None
+        self.context = None
+        self.extract_seconds = 0.0
+
+    def _new_context(self, surface):
+        context = cairocffi.Context(surface)
+        context.scale(self.resolution, self.resolution)
+        context.set_source_rgb(1, 1, 1) # white
+
+        if not self.antialias:
+            font_options = surface.get_font_options()
+            font_options.set_antialias(cairocffi.ANTIALIAS_NONE)
+            context.set_font_options(font_options)
+
+        context.set_font_face(self.font_face)
+        context.set_font_size(self.size)
+        return context
+
+    # Get a context for drawing in the top left width x height pixels of
+    # the scratch surface, which are cleared to black.
+    def _scratch(self, width, height):
+        width = max(width, 1)
+        height = max(height, 1)
+        if (self.surface is None or
+            width > self.surface.get_width() or
+            height > self.surface.get_height()):
+            if self.surface is not None:
+                width = max(width, self.surface.get_width())
+                height = max(height, self.surface.get_height())
+            self.surface = cairocffi.ImageSurface(self.format, width, height)
+            self.context = self._new_context(self.surface)
+        else:
+            self.context.save()
+            self.context.identity_matrix()
+            self.context.set_operator(cairocffi.OPERATOR_CLEAR)
+            self.context.rectangle(0, 0, width, height)
+            self.context.fill()
+            self.context.restore()
+        return self.context
+
+    def measure(self, text):
+        return self.measure_context.text_extents(text)
+
+    # The runs of the top left width x height pixels of the scratch surface.
+    def _extract(self, bottom_up, width, height):
+        start = time.perf_counter()
+        runs = extract_runs(self.surface, bottom_up, width, height, self.threshold)
+        self.extract_seconds += time.perf_counter() - start
+        return runs
+
+    def text_to_glyphs(self, x, y, text):
+        return self.scaled_font.text_to_glyphs(x, y, text, False)
+
+    # Draw text with its origin at user space position x, y into the top
+    # left width x height pixels of the scratch surface, self.surface.  If
+    # debug_png is given, that region is also written to it as a PNG file.
+    def draw_text(self, text, x, y, width, height, debug_png = None):
+        context = self._scratch(width, height)
+        context.move_to(x, y)
+        context.show_text(text)
+        if debug_png is not None:
+            self.surface.create_for_rectangle(0, 0, max(width, 1), max(height, 1)).write_to_png(debug_png)
 
-        self._setup_context(1, 1)
-        te = self.context.text_extents(self.text)
+    # Draw text as draw_text() does and return the runs of the pixels it
+    # was drawn in, bottom row first.
+    def render_text(self, text, x, y, width, height, debug_png = None):
+        self.draw_text(text, x, y, width, height, debug_png)
+        return self._extract(True, width, height)
+
+    # Draw text as render_text() does, but strip_height rows at a time,
+    # so that only a width x strip_height scratch surface is needed, and
+    # yield the runs of each strip as it is drawn, bottom strip first.
+    # Each strip is drawn with the text shifted up by a whole number of
+    # pixels, so the result is the same as drawing it all at once.
+    def render_text_strips(self, text, x, y, width, height, strip_height):
+        bottom = height
+        while bottom > 0:
+            top = max(bottom - strip_height, 0)
+            context = self._scratch(width, bottom - top)
+            context.save()
+            context.identity_matrix()
+            context.translate(0, -top)
+            context.scale(self.resolution, self.resolution)
+            context.move_to(x, y)
+            context.show_text(text)
+            context.restore()
+            runs = self._extract(True, width, bottom - top)
+            for i in range(0, len(runs), 3):
+                runs[i] += top
+            yield runs
+            bottom = top
+
+    # Render a single glyph at user space position x, y, translated by a
+    # whole number of pixels to keep it near the corner of the scratch
+    # surface, and return its runs relative to the integer part (ix, iy)
+    # of its device position.
+    def render_glyph(self, index, x, y, ix, iy):
+        (x_bearing, y_bearing, width, height,
+         x_advance, y_advance) = self.scaled_font.glyph_extents([(index, 0, 0)])
+        margin_x = math.ceil(-x_bearing * self.resolution) + 2
+        margin_y = math.ceil(-y_bearing * self.resolution) + 2
+        glyph_width = margin_x + math.ceil((x_bearing + width) * self.resolution) + 4
+        glyph_height = margin_y + math.ceil((y_bearing + height) * self.resolution) + 4
+        context = self._scratch(glyph_width, glyph_height)
+        context.save()
+        context.identity_matrix()
+        context.translate(margin_x - ix, margin_y - iy)
+        context.scale(self.resolution, self.resolution)
+        context.show_glyphs([(index, x, y)])
+        context.restore()
+        runs = self._extract(False, max(glyph_width, 1), max(glyph_height, 1))
+        for i in range(0, len(runs), 3):
+            runs[i] -= margin_y
+            runs[i + 1] -= margin_x
+            runs[i + 2] -= margin_x
+        return runs
+
+    # Assemble the runs of a string from the glyph cache, given its glyphs
+    # as returned by text_to_glyphs().
+    def compose_glyphs(self, glyphs, width, height, bottom_up = False):
+        pieces = []
+        for index, x, y in glyphs:
+            device_x = x * self.resolution
+            device_y = y * self.resolution
+            ix = math.floor(device_x)
+            iy = math.floor(device_y)
+            key = (self.face, self.size, self.weight, self.slant, self.resolution, self.antialias,
+                   self.format, self.threshold, index, device_x - ix, device_y - iy)
+            runs = self.glyph_cache.get(key, lambda: self.render_glyph(index, x, y, ix, iy))
+            pieces.append((runs, ix, iy))
+        return compose_runs(pieces, width, height, bottom_up)
+
+
+# Rasterize one string.  Without a session, a private one is created for
+# it, in which case get_pixel() and row_iter() can be used to look at the
+# rendered surface; with a shared session, whose surface may be larger than
+# the label and is drawn over by the next label, only the runs are kept.
+class RasterizeText:
+    def __init__(self,
+                 text,        # text to render
+                 resolution,  # resolution in dpi
+                 face,
+                 size,        # size in inches
+                 bold, italic, oblique,
+                 antialias = False,
+                 glyph_cache = None,  # GlyphCache to compose the text from
+                 session = None,      # RasterSession to render with
+                 debug_png = None,    # file to write the rendered text to
+                 format = FORMAT_RGB24,
+                 threshold = 1,
+                 strip_height = None):  # render in strips of this many rows
+        if strip_height is not None and strip_height <= 0:
+            raise ValueError('strip height must be positive, not %d' % strip_height)
+        if debug_png is not None and (glyph_cache is not None or strip_height or
+                                      (session is not None and session.glyph_cache is not None)):
+            raise ValueError("can't write a debug PNG of text composed from cached glyphs or rendered in strips")
+        private = session is None
+        if private:
+            session = RasterSession(resolution, face, size, bold, italic, oblique,
+                                    antialias, glyph_cache, format, threshold)
+        self.session = session
+        self.text = text
+        self.resolution = session.resolution
+        self.face = session.face
+        self.size = session.size
+        self.slant = session.slant
+        self.weight = session.weight
+        self.antialias = session.antialias
+
+        te = session.measure(self.text)
         #print(te)
         (self.x_bearing, self.y_bearing, self.width, self.height, x_advance, y_advance) = te
 
         self.origin = (-self.x_bearing, -self.y_bearing)
 
-        self._setup_context(int(self.width * self.resolution),
-                            int(self.height * self.resolution))
-        self.context.move_to(self.origin[0], self.origin[1])
-        self.context.show_text(self.text)
-        self.surface.write_to_png('test.png')
+        self.width_pixels = int(self.width * self.resolution)
+        self.height_pixels = int(self.height * self.resolution)
+
+        self.glyphs = None
+        self.strip_height = strip_height
+        self.runs = None
+        self.surface = None
+
+        if session.glyph_cache is not None:
+            # Don't render the string; get_runs() will assemble it from
+            # individually rendered glyphs, placed where show_text() would
+            # have put them.
+            self.glyphs = session.text_to_glyphs(self.origin[0], self.origin[1], self.text)
+        elif strip_height:
+            # Rendered a strip at a time by iter_run_strips()
+            pass
+        else:
+            self.runs = session.render_text(self.text, self.origin[0], self.origin[1],
+                                            self.width_pixels, self.height_pixels, debug_png)
+            if private:
+                self.surface = session.surface
 
     def get_size_pixels(self):
-        return (self.surface.get_width(), self.surface.get_height())
+        return (self.width_pixels, self.height_pixels)
 
     def get_origin(self):
         return self.origin
 
+    # As for RasterRowIterator.get_pixel(): the bytes of the pixel, or for
+    # an A1 surface its bit.
     def get_pixel(self, x, y):
-        i = (y * self.surface_stride + x) * 4
-        return self.surface_data[i:i+4]
+        return RasterRowIterator(self.surface, y).get_pixel(x)
 
     def row_iter(self, y):
         return RasterRowIterator(self.surface, y)
+
+    def get_runs(self, bottom_up = False):
+        if self.glyphs is not None:
+            return self.session.compose_glyphs(self.glyphs, self.width_pixels, self.height_pixels, bottom_up)
+        if self.runs is None:
+            self.runs = array.array('i')
+            for runs in self.iter_run_strips():
+                self.runs.extend(runs)
+        if bottom_up:
+            return self.runs
+        return reverse_rows(self.runs)
+
+    # Yield the runs, bottom row first, in pieces as they become available.
+    # When rendering in strips, the strips aren't drawn until they are asked
+    # for, so nothing else should use the session in the meantime.
+    def iter_run_strips(self):
+        if self.glyphs is None and self.runs is None:
+            yield from self.session.render_text_strips(self.text, self.origin[0], self.origin[1],
+                                                       self.width_pixels, self.height_pixels,
+                                                       self.strip_height)
+        else:
+            yield self.get_runs(bottom_up = True)
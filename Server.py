@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+# Long-running label generation server, and its client
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The server runs eagletext.py command lines sent by clients, keeping its
+# fonts and glyph caches warm between them, so that a client pays for
+# neither interpreter startup and imports nor font lookup.  The client
+# only imports this module, which doesn't import anything heavy until it
+# is acting as a server.
+#
+# Client and server exchange frames of a one byte kind, a four byte
+# big-endian length, and that many bytes of payload:
+#   'r'  client request, as JSON:
+#          { "argv": [...], "cwd": "...", "stdin": "..." or null }
+#   'o'  the command's standard output (normally the library)
+#   'e'  the command's standard error
+#   'x'  the command's exit status, as JSON: { "status": n }
+# Relative paths in the command line are taken relative to the client's
+# cwd, and the server reads and writes files as itself.  stdin is only
+# sent when the command line reads the manifest from standard input.
+
+from collections import OrderedDict
+import io
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import traceback
+
+
+_frame_header = struct.Struct('>cI')
+
+
+def _send_frame(sock, kind, payload):
+    sock.sendall(_frame_header.pack(kind, len(payload)) + payload)
+
+
+def _recv_exact(sock, size):
+    pieces = []
+    while size:
+        piece = sock.recv(min(size, 1 << 16))
+        if not piece:
+            raise EOFError('connection closed')
+        pieces.append(piece)
+        size -= len(piece)
+    return b''.join(pieces)
+
+
+def _recv_frame(sock):
+    kind, size = _frame_header.unpack(_recv_exact(sock, _frame_header.size))
+    return kind, _recv_exact(sock, size)
+
+
+def default_address():
+    return os.environ.get('EAGLETEXT_SERVER',
+                          os.path.join(tempfile.gettempdir(), 'eagletext-%d.sock' % os.getuid()))
+
+
+# An address is either a Unix socket path or, if it has no slash, a TCP
+# [host]:port; the host defaults to the loopback address, and can only be
+# a name or address on the loopback interface.  Any local user
+# can connect to a TCP server, and have it read and write files as the
+# server's user, so a Unix socket (which only its owner can use) is
+# normally the better choice.
+def parse_address(address):
+    if '/' not in address and ':' in address:
+        host, port = address.rsplit(':', 1)
+        host = host or '127.0.0.1'
+        if not _is_loopback(host):
+            raise ValueError('%s: only loopback addresses can be used' % address)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+# Whether every address host resolves to is a loopback address.  A
+# request names files for the server to read and write, so the server
+# must never be reachable from other machines.
+def _is_loopback(host):
+    try:
+        infos = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(info[4][0]).is_loopback for info in infos)
+
+
+# Writes to a connection as frames of one kind.
+class _FrameFile(io.RawIOBase):
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        _send_frame(self.sock, self.kind, bytes(data))
+        return len(data)
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            kind, payload = _recv_frame(self.request)
+        except (EOFError, OSError):
+            return
+        if kind != b'r':
+            return
+        self.server.label_server.handle_request(self.request, json.loads(payload.decode('utf-8')))
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# Serves eagletext.py command lines at address (see parse_address()).  At
+# most max_requests are run at once; others wait their turn.  Renderers
+# (see Label.LabelRenderer), with their font sessions and glyph caches,
+# are kept between requests, at most one per request that can run at once
+# for each combination of rendering options, and for no more than
+# max_renderer_options combinations (the least recently used are dropped).
+# Each is kept in a Label.LabelMeasurer, so that the text extents measured
+# for --measure are kept with it.
+class LabelServer:
+    def __init__(self, address, max_requests = 4, max_renderer_options = 4):
+        import eagletext
+        self.eagletext = eagletext
+        # Report errors as eagletext.py, not as the server script.
+        eagletext.parser.prog = 'eagletext.py'
+        self.limit = threading.BoundedSemaphore(max_requests)
+        self.renderers_lock = threading.Lock()
+        self.renderers = OrderedDict()
+        self.max_renderer_options = max_renderer_options
+
+        family, address = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                # Remove the socket of a server that is no longer running.
+                try:
+                    with socket.socket(socket.AF_UNIX) as s:
+                        s.connect(address)
+                except OSError:
+                    os.unlink(address)
+            old_umask = os.umask(0o077)
+            try:
+                self.server = _UnixServer(address, _RequestHandler)
+            finally:
+                os.umask(old_umask)
+        else:
+            self.server = _TCPServer(address, _RequestHandler)
+        self.server.label_server = self
+        self.address = address
+
+    def serve_forever(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if isinstance(self.address, str):
+                try:
+                    os.unlink(self.address)
+                except OSError:
+                    pass
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def _get_measurer(self, args):
+        key = (args.glyph_cache, args.debug_png, args.raster_format, args.strip_height)
+        with self.renderers_lock:
+            idle = self.renderers.get(key)
+            if idle:
+                self.renderers.move_to_end(key)
+                return key, idle.pop()
+        from Label import LabelRenderer, LabelMeasurer
+        return key, LabelMeasurer(LabelRenderer(glyph_cache_size = args.glyph_cache,
+                                                debug_png_dir = args.debug_png,
+                                                raster_format = args.raster_format,
+                                                strip_height = args.strip_height))
+
+    def _put_measurer(self, key, measurer):
+        with self.renderers_lock:
+            self.renderers.setdefault(key, []).append(measurer)
+            self.renderers.move_to_end(key)
+            while len(self.renderers) > self.max_renderer_options:
+                self.renderers.popitem(last = False)
+
+    def handle_request(self, sock, request):
+        eagletext = self.eagletext
+        stdout = io.BufferedWriter(_FrameFile(sock, b'o'), 1 << 16)
+        stderr = io.TextIOWrapper(_FrameFile(sock, b'e'), encoding = 'utf-8', write_through = True)
+        status = 0
+        with self.limit:
+            try:
+                # Have argparse report errors (and --help) to the client.
+                output = eagletext.parser.output
+                output.stdout = io.TextIOWrapper(_FrameFile(sock, b'o'), encoding = 'utf-8',
+                                                 write_through = True)
+                output.stderr = stderr
+                try:
+                    args = eagletext.parser.parse_args(request['argv'])
+                    if not args.text and args.manifest is None:
+                        eagletext.parser.error('no text or manifest given')
+                except SystemExit as e:
+                    status = e.code or 0
+                    args = None
+                finally:
+                    output.stdout = output.stderr = None
+                if args is not None:
+                    for option in eagletext.path_options:
+                        value = getattr(args, option)
+                        if value is not None and value != '-':
+                            setattr(args, option, os.path.join(request['cwd'], value))
+                    stdin = io.StringIO(request.get('stdin') or '')
+                    key = renderer = measurer = None
+                    try:
+                        if args.jobs <= 1:
+                            key, measurer = self._get_measurer(args)
+                            renderer = measurer.renderer
+                        eagletext.generate(args, stdin, stdout, stderr, renderer, measurer)
+                    except (ValueError, OSError) as e:
+                        print('%s: %s' % (eagletext.parser.prog, e), file = stderr)
+                        status = 1
+                    except Exception:
+                        traceback.print_exc(file = stderr)
+                        status = 1
+                    if measurer is not None:
+                        self._put_measurer(key, measurer)
+                stdout.flush()
+                _send_frame(sock, b'x', json.dumps({ 'status': status }).encode('utf-8'))
+            except OSError:
+                # The client went away.
+                pass
+
+
+# Whether an eagletext.py command line reads its manifest from stdin.
+def _reads_stdin(argv):
+    for i, arg in enumerate(argv):
+        if arg in ('-m', '--manifest') and argv[i + 1:i + 2] == ['-']:
+            return True
+        if arg in ('-m-', '--manifest=-'):
+            return True
+    return False
+
+
+# Run an eagletext.py command line on the server at address, copying its
+# output to stdout and stderr (binary or text files, by default sys.stdout
+# and sys.stderr), and return its exit status.
+def run_client(address, argv, stdin = None, stdout = None, stderr = None):
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    if isinstance(stdout, io.TextIOBase):
+        stdout.flush()
+        stdout = stdout.buffer
+    if isinstance(stderr, io.TextIOBase):
+        stderr.flush()
+        stderr = stderr.buffer
+
+    request = { 'argv': list(argv),
+                'cwd':  os.getcwd(),
+                'stdin': stdin.read() if _reads_stdin(argv) else None }
+    family, address = parse_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(address)
+        _send_frame(sock, b'r', json.dumps(request).encode('utf-8'))
+        while True:
+            kind, payload = _recv_frame(sock)
+            if kind == b'o':
+                stdout.write(payload)
+            elif kind == b'e':
+                stderr.write(payload)
+                stderr.flush()
+            elif kind == b'x':
+                stdout.flush()
+                return json.loads(payload.decode('utf-8'))['status']
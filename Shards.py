@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Generate Eagle CAD libraries of rasterized text split across several files
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Eagle slows down badly on libraries with hundreds of packages, so a
+# large build can be split into shards, each a complete library:
+#   generate_shards(specs, 'labels.lbr', shards = 4)
+# writes labels-1.lbr to labels-4.lbr and an index, labels.json:
+#   { "format": 1,
+#     "shards": [ { "number": 1, "file": "labels-1.lbr",
+#                   "digest": "...", "labels": [ "HELLO", ... ] }, ... ],
+#     "packages": { "HELLO": "labels-1.lbr", ... } }
+# mapping each package to the shard holding it (along with the devicesets
+# that use it).  File names in the index are relative to its directory.
+#
+# When the index already exists, labels stay in the shards they were in,
+# and new labels go into new shards, so that a shard only changes when
+# its own labels do.  A shard whose labels and their render parameters
+# are unchanged (its digest matches) isn't rendered or written again.
+
+from collections import OrderedDict
+import hashlib
+import io
+import json
+import math
+import os
+
+from Label import LabelRenderer, LabelMeasurer, intern_specs, render_hash
+from Library import generate_library, write_replacing
+from Stats import BuildStats
+
+
+_format = 1
+
+
+def index_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def shard_path(path, number):
+    return '%s-%d.lbr' % (os.path.splitext(path)[0], number)
+
+
+# The index written by a previous build for path, or None if there isn't
+# one.
+def read_index(path):
+    try:
+        with open(index_path(path)) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        raise ValueError('%s: %s' % (index_path(path), e)) from None
+    if not isinstance(index, dict) or index.get('format') != _format:
+        raise ValueError('%s: not a shard index' % index_path(path))
+    return index
+
+
+# Split groups (lists of labels sharing a package) into consecutive
+# chunks: at most about max_primitives estimated primitives each, if given,
+# or else shards chunks of as near the same number of packages as possible.
+# The estimates are from the labels' measured sizes (see
+# Label.LabelMeasurer), by measurer if given.
+def _split(groups, shards = None, max_primitives = None, measurer = None):
+    if shards is not None and shards <= 0:
+        raise ValueError('number of shards must be positive, not %d' % shards)
+    if max_primitives is not None and max_primitives <= 0:
+        raise ValueError('primitives per shard must be positive, not %d' % max_primitives)
+    if max_primitives:
+        if measurer is None:
+            measurer = LabelMeasurer()
+        chunks = []
+        chunk = []
+        total = 0
+        for group in groups:
+            estimate = measurer.measure(group[0]).primitives
+            if chunk and total + estimate > max_primitives:
+                chunks.append(chunk)
+                chunk = []
+                total = 0
+            chunk.append(group)
+            total += estimate
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+    size = math.ceil(len(groups) / (shards or 1)) or 1
+    return [groups[i:i + size] for i in range(0, len(groups), size)]
+
+
+# Assign the labels in specs to shards, returning a list of (number,
+# labels) in order of number, each shard's labels in the order given.
+# previous is the index of an earlier build, whose assignments are kept;
+# labels that weren't in it are split into new shards, which are numbered
+# after the existing ones.  measurer is as for _split().
+def plan_shards(specs, shards = None, max_primitives = None, previous = None, measurer = None):
+    labels = []
+    package_names = { }
+    groups = OrderedDict()
+    for spec, package_name in intern_specs(specs):
+        labels.append(spec)
+        package_names[spec.name] = package_name
+        groups.setdefault(package_name, []).append(spec)
+
+    numbers = { }
+    next_number = 1
+    if previous is not None:
+        files = { shard['file']: shard['number'] for shard in previous['shards'] }
+        for package_name, file in previous['packages'].items():
+            if package_name in groups and file in files:
+                numbers[package_name] = files[file]
+        next_number = max(files.values(), default = 0) + 1
+
+    new_groups = [group for package_name, group in groups.items() if package_name not in numbers]
+    if numbers:
+        # The number of shards only applies to the first build.
+        shards = None
+    for number, chunk in enumerate(_split(new_groups, shards, max_primitives, measurer),
+                                   next_number):
+        for group in chunk:
+            numbers[group[0].name] = number
+
+    plan = OrderedDict((number, []) for number in sorted(set(numbers.values())))
+    for spec in labels:
+        plan[numbers[package_names[spec.name]]].append(spec)
+    return list(plan.items())
+
+
+# Everything that a shard's contents depend on.
+def shard_digest(specs):
+    text = json.dumps([[spec.name, render_hash(spec)] for spec in specs])
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# Build one shard at path.  Returns the bytes written, a BuildStats (if
+# with_stats) and the log text.
+def _build_shard(specs, path, cache, renderer, with_stats, verbose, renderer_options):
+    stats = BuildStats() if with_stats else None
+    log = io.StringIO() if verbose else None
+    size = write_replacing(path, 'wb',
+                            lambda f: generate_library(specs, f, 1, cache, renderer, None,
+                                                       stats, log, **renderer_options))
+    return size, stats, log.getvalue() if log is not None else ''
+
+
+# Render the labels in specs into shards, named after path (see
+# shard_path()), and write the index (see index_path()).  Shards are
+# split by shards or max_primitives, as for _split(), on the first build;
+# on later builds, as described above.  Shard files that are no longer in
+# the index are removed.  Returns the index.
+#
+# Up to jobs shards are built at once, each in its own process, so that
+# they are rendered and written concurrently; with jobs = 1 they are built
+# one at a time by renderer.  cache, stats and log are as for
+# Library.generate_library(), and any other keyword arguments are passed
+# on to Label.LabelRenderer.
+def generate_shards(specs, path, shards = None, max_primitives = None, jobs = 1, cache = None,
+                    renderer = None, stats = None, log = None, **renderer_options):
+    previous = read_index(path)
+    measurer = None
+    if max_primitives:
+        if renderer is None:
+            renderer = LabelRenderer(**renderer_options)
+        measurer = LabelMeasurer(renderer)
+    plan = plan_shards(specs, shards, max_primitives, previous, measurer)
+    previous_shards = { }
+    if previous is not None:
+        previous_shards = { shard['number']: shard for shard in previous['shards'] }
+
+    directory = os.path.dirname(os.path.abspath(path))
+    index = { 'format': _format, 'shards': [], 'packages': { } }
+    builds = []
+    for number, shard_specs in plan:
+        file = os.path.basename(shard_path(path, number))
+        digest = shard_digest(shard_specs)
+        shard = { 'number': number,
+                  'file':   file,
+                  'digest': digest,
+                  'labels': [spec.name for spec in shard_specs] }
+        index['shards'].append(shard)
+        for package_name in dict.fromkeys(package_name for spec, package_name in
+                                          intern_specs(shard_specs)):
+            index['packages'][package_name] = file
+
+        old = previous_shards.get(number)
+        if (old is not None and old['digest'] == digest and
+            os.path.exists(os.path.join(directory, file))):
+            if log is not None:
+                print('%s: unchanged' % file, file = log)
+            continue
+        builds.append((file, shard_specs))
+
+    total = 0
+    def finish(file, count, result):
+        nonlocal total
+        size, shard_stats, log_text = result
+        total += size
+        if stats is not None:
+            stats.merge(shard_stats)
+        if log is not None:
+            log.write(log_text)
+            print('%s: %d labels, %d bytes' % (file, count, size), file = log)
+
+    if jobs <= 1 or len(builds) <= 1:
+        if renderer is None:
+            renderer = LabelRenderer(**renderer_options)
+        for file, shard_specs in builds:
+            finish(file, len(shard_specs),
+                   _build_shard(shard_specs, os.path.join(directory, file), cache, renderer,
+                                stats is not None, log is not None, renderer_options))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers = min(jobs, len(builds))) as executor:
+            futures = [(file, len(shard_specs),
+                        executor.submit(_build_shard, shard_specs, os.path.join(directory, file),
+                                        cache, None, stats is not None, log is not None,
+                                        renderer_options))
+                       for file, shard_specs in builds]
+            for file, count, future in futures:
+                finish(file, count, future.result())
+
+    # The index is written last, so it never names a shard that hasn't
+    # been written.
+    write_replacing(index_path(path), 'w',
+                     lambda f: f.write(json.dumps(index, indent = 1) + '\n'))
+
+    if previous is not None:
+        files = set(shard['file'] for shard in index['shards'])
+        for shard in previous['shards']:
+            # Only remove files with the names this would have given them.
+            if (shard['file'] not in files and
+                shard['file'] == os.path.basename(shard_path(path, shard['number']))):
+                try:
+                    os.unlink(os.path.join(directory, shard['file']))
+                except FileNotFoundError:
+                    pass
+                if log is not None:
+                    print('%s: removed' % shard['file'], file = log)
+
+    if stats is not None:
+        stats.finish(total)
+    return index
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Timing and size statistics for rasterized text library generation
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+
+
+# The stages of generating a label, in order.  rasterize (measuring and
+# drawing the text with Cairo), runs (extracting runs from the drawn
+# pixels) and decompose are timed by Label.render_label() (in the worker
+# process, when rendering in parallel), and replaced by cache, reading the
+# rendering from the render cache, when the label is found there; build is
+# making the package and deviceset, and write is serializing them.
+stages = ('cache', 'rasterize', 'runs', 'decompose', 'build', 'write')
+
+
+# Collects statistics for a library build.  For each label, add_label()
+# makes a record:
+#   { 'name': ..., 'width_pixels': ..., 'height_pixels': ...,
+#     'runs': ..., 'rectangles': ..., 'polygons': ..., 'vertices': ...,
+#     'bytes': ..., 'error': ..., 'seconds': { stage: wall time, ... } }
+# which is passed to callback, if given, and kept for to_dict() unless
+# keep_labels is false.  Labels copied unchanged from a previous library
+# are recorded by add_reused(), with just their name, bytes and
+# 'reused': True, and labels that share another label's package by
+# add_shared(), with their name, bytes and the 'package' they use.
+# finish() records the total bytes written and the
+# elapsed time, which includes anything not attributed to a stage.  For a
+# library built in memory rather than written, the bytes are None.
+class BuildStats:
+    def __init__(self, callback = None, keep_labels = True):
+        self.callback = callback
+        self.labels = [] if keep_labels else None
+        self.label_count = 0
+        self.reused_count = 0
+        self.shared_count = 0
+        self.seconds = dict.fromkeys(stages, 0.0)
+        self.counts = dict.fromkeys(('pixels', 'runs', 'rectangles', 'polygons', 'vertices'), 0)
+        self.max_error = None
+        self.bytes_written = None
+        self.start = time.perf_counter()
+        self.elapsed = None
+
+    def add_label(self, spec, rendered, build_seconds, write_seconds, bytes_written):
+        seconds = dict(rendered.seconds or { })
+        seconds['build'] = build_seconds
+        seconds['write'] = write_seconds
+        record = { 'name':          spec.name,
+                   'width_pixels':  rendered.width_pixels,
+                   'height_pixels': rendered.height_pixels,
+                   'runs':          rendered.run_count,
+                   'bytes':         bytes_written,
+                   'seconds':       seconds }
+        if rendered.error is not None:
+            record['error'] = rendered.error
+            self.max_error = max(self.max_error or 0, rendered.error)
+        if rendered.polygons is not None:
+            record['polygons'] = len(rendered.polygons)
+            record['vertices'] = sum(len(p) for p in rendered.polygons)
+        else:
+            record['rectangles'] = len(rendered.rects) // 4
+
+        self.label_count += 1
+        for stage, t in seconds.items():
+            self.seconds[stage] += t
+        self.counts['pixels'] += rendered.width_pixels * rendered.height_pixels
+        for key in ('runs', 'rectangles', 'polygons', 'vertices'):
+            self.counts[key] += record.get(key, 0)
+        if self.labels is not None:
+            self.labels.append(record)
+        if self.callback is not None:
+            self.callback(record)
+        return record
+
+    def add_reused(self, spec, bytes_written):
+        record = { 'name':   spec.name,
+                   'bytes':  bytes_written,
+                   'reused': True }
+        self.reused_count += 1
+        if self.labels is not None:
+            self.labels.append(record)
+        if self.callback is not None:
+            self.callback(record)
+        return record
+
+    def add_shared(self, spec, package_name, bytes_written):
+        record = { 'name':    spec.name,
+                   'bytes':   bytes_written,
+                   'package': package_name }
+        self.shared_count += 1
+        if self.labels is not None:
+            self.labels.append(record)
+        if self.callback is not None:
+            self.callback(record)
+        return record
+
+    # Add the labels recorded by another BuildStats, such as one that
+    # recorded part of the build in another process.
+    def merge(self, other):
+        self.label_count += other.label_count
+        self.reused_count += other.reused_count
+        self.shared_count += other.shared_count
+        for stage, t in other.seconds.items():
+            self.seconds[stage] += t
+        for key, n in other.counts.items():
+            self.counts[key] += n
+        if other.max_error is not None:
+            self.max_error = max(self.max_error or 0, other.max_error)
+        for record in other.labels or []:
+            if self.labels is not None:
+                self.labels.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def finish(self, bytes_written):
+        self.bytes_written = bytes_written
+        self.elapsed = time.perf_counter() - self.start
+
+    def to_dict(self):
+        result = { 'labels':        self.label_count,
+                   'reused':        self.reused_count,
+                   'shared':        self.shared_count,
+                   'seconds':       self.seconds,
+                   'elapsed':       self.elapsed,
+                   'max_error':     self.max_error,
+                   'bytes_written': self.bytes_written }
+        result.update(self.counts)
+        if self.labels is not None:
+            result['label_stats'] = self.labels
+        return result
+
+    def write_json(self, outfile):
+        json.dump(self.to_dict(), outfile, indent = 1)
+        outfile.write('\n')
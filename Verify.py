@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# Check that rasterized text packages cover exactly the pixels of the text
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A package's rectangles and polygons are mapped back onto the pixel grid
+# of its label and filled into a coverage count with numpy, and the label
+# is rendered again, the plain way (the whole string at once, into an
+# RGB24 surface, without the glyph cache or strips), to compare with:
+#   report = verify_package(package)
+#   if report.extra or report.missing:
+#       ...
+# Packages record the parameters they were rendered with in their
+# descriptions (see Label.package_description()), so a library can be
+# checked without the manifest it was built from.
+
+from collections import deque, namedtuple
+
+from Eagle import EaglePackage, EagleCompactPackage, iter_library
+from Label import LabelRenderer, rasterize_label, alignment_offsets, spec_from_package, tolerance_pixels
+
+
+# numpy is only needed here, so that the rest of eagletext works without
+# it, it isn't imported until a package is checked.
+numpy = None
+
+def _import_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            raise ImportError('checking packages needs numpy, which is not installed') from None
+        numpy = module
+    return numpy
+
+
+# The result of checking one package, in pixels.  extra pixels are covered
+# by the package but aren't part of the text, missing pixels are the
+# reverse, and overlap pixels are covered by more than one primitive.
+# off_grid counts the primitives with a corner that isn't on the label's
+# pixel grid (or, for polygons, that have a diagonal edge), which can't be
+# checked exactly.  tolerance is the label's simplify tolerance in pixels, and
+# deviation the furthest that any extra or missing pixel is from the
+# pixels of the text (or of the package), counted up to one more than
+# tolerance; with no extra or missing pixels it is 0.
+CoverageReport = namedtuple('CoverageReport', ['name', 'width_pixels', 'height_pixels',
+                                               'pixels', 'rectangles', 'polygons',
+                                               'extra', 'missing', 'overlap', 'off_grid',
+                                               'tolerance', 'deviation'])
+
+
+# Whether a report shows the package to be a faithful rendering of its
+# label: every primitive on the grid, and the pixels of the text covered
+# exactly, or (if the label was simplified) to within its tolerance.
+def passed(report):
+    if report.off_grid:
+        return False
+    return report.deviation <= report.tolerance
+
+
+# The rectangles (an n x 4 array of x1, y1, x2, y2) and polygons (a list of
+# n x 2 arrays of vertices) on layer of a package, in millimetres.
+def package_primitives(package, layer):
+    _import_numpy()
+    layer_text = str(layer)
+    rects = []
+    if isinstance(package, EagleCompactPackage):
+        rects.extend(rect[1:] for rect in package.iter_rectangles() if rect[0] == layer)
+        children = package._other_children()
+    else:
+        children = package.get_element()
+    polygons = []
+    for child in children:
+        if child.get('layer') != layer_text:
+            continue
+        if child.tag == 'rectangle':
+            rects.append(tuple(float(child.get(k)) for k in ('x1', 'y1', 'x2', 'y2')))
+        elif child.tag == 'polygon':
+            vertices = [(float(v.get('x')), float(v.get('y'))) for v in child.iter('vertex')]
+            polygons.append(numpy.array(vertices, dtype = float).reshape(-1, 2))
+    return numpy.array(rects, dtype = float).reshape(-1, 4), polygons
+
+
+# Round pixel coordinates to the grid, returning the integer coordinates
+# and which of them were more than a thousandth of a pixel off it.
+def _snap(values):
+    rounded = numpy.rint(values)
+    return rounded.astype(numpy.int64), numpy.abs(values - rounded) > 1e-3
+
+
+# Add one to count for each polygon covering each pixel.  vertices are in
+# pixels (x, row), with count's origin at (x0, row0).  Returns false if the
+# polygon has a diagonal edge, which isn't filled.
+def _fill_polygon(count, vertices, x0, row0):
+    xs = vertices[:, 0]
+    rows = vertices[:, 1]
+    next_xs = numpy.roll(xs, -1)
+    next_rows = numpy.roll(rows, -1)
+    rectilinear = bool(numpy.all((xs == next_xs) | (rows == next_rows)))
+    vertical = (xs == next_xs) & (rows != next_rows)
+    edge_x = xs[vertical] - x0
+    edge_lo = numpy.minimum(rows, next_rows)[vertical] - row0
+    edge_hi = numpy.maximum(rows, next_rows)[vertical] - row0
+    if not len(edge_x):
+        return rectilinear
+
+    # Fill by the even-odd rule within the polygon's bounding box: a pixel
+    # is inside if an odd number of vertical edges are at or left of it.
+    # That also leaves out holes joined to the outline by a channel.
+    left, right = edge_x.min(), edge_x.max()
+    top, bottom = edge_lo.min(), edge_hi.max()
+    edges = numpy.zeros((bottom - top + 1, right - left + 1), numpy.int32)
+    numpy.add.at(edges, (edge_lo - top, edge_x - left), 1)
+    numpy.add.at(edges, (edge_hi - top, edge_x - left), -1)
+    inside = (edges.cumsum(0).cumsum(1) & 1)[:-1, :-1]
+    count[top:bottom, left:right] += inside
+    return rectilinear
+
+
+# Grow a mask by one pixel in each direction, diagonals included.
+def _dilate(mask):
+    grown = mask.copy()
+    grown[1:] |= mask[:-1]
+    grown[:-1] |= mask[1:]
+    rows = grown.copy()
+    grown[:, 1:] |= rows[:, :-1]
+    grown[:, :-1] |= rows[:, 1:]
+    return grown
+
+
+# How far, in pixels, the furthest of the stray pixels is from the pixels
+# of target, counting no further than limit + 1.
+def _deviation(stray, target, limit):
+    if not stray.any():
+        return 0
+    reach = target
+    for distance in range(1, limit + 1):
+        reach = _dilate(reach)
+        stray = stray & ~reach
+        if not stray.any():
+            return distance
+    return limit + 1
+
+
+# Check rects and polygons (as returned by package_primitives()) against a
+# fresh rendering of spec, by renderer (a Label.LabelRenderer, by default a
+# new one with default options).
+def verify_primitives(spec, rects, polygons, renderer = None):
+    _import_numpy()
+    if renderer is None:
+        renderer = LabelRenderer()
+    raster = rasterize_label(spec, renderer.get_session(spec))
+    width_pixels, height_pixels = raster.get_size_pixels()
+    runs = numpy.frombuffer(raster.get_runs(), dtype = numpy.int32).reshape(-1, 3)
+    resolution = spec.resolution
+    xoffset, yoffset = alignment_offsets(spec, width_pixels, height_pixels, raster.get_origin())
+    overlap = spec.overlap/(200 * resolution)
+
+    # The inverse of the arithmetic in Label.build_package().
+    off_grid = 0
+    x1, off_x1 = _snap((rects[:, 0] / 25.4 + xoffset) * resolution)
+    x2, off_x2 = _snap((rects[:, 2] / 25.4 + xoffset) * resolution)
+    row2, off_y1 = _snap(height_pixels - (rects[:, 1] / 25.4 + overlap + yoffset) * resolution)
+    row1, off_y2 = _snap(height_pixels - (rects[:, 3] / 25.4 - overlap + yoffset) * resolution)
+    off_grid += int(numpy.count_nonzero(off_x1 | off_x2 | off_y1 | off_y2))
+    x1, x2 = numpy.minimum(x1, x2), numpy.maximum(x1, x2)
+    row1, row2 = numpy.minimum(row1, row2), numpy.maximum(row1, row2)
+
+    pixel_polygons = []
+    for vertices in polygons:
+        xp, off_x = _snap((vertices[:, 0] / 25.4 + xoffset) * resolution)
+        rp, off_y = _snap(height_pixels - (vertices[:, 1] / 25.4 + yoffset) * resolution)
+        if numpy.any(off_x | off_y):
+            off_grid += 1
+        pixel_polygons.append(numpy.stack((xp, rp), axis = 1))
+
+    # The grid covers the label and anything drawn outside it.
+    x0 = min([0, x1.min(initial = 0)] + [p[:, 0].min() for p in pixel_polygons if len(p)])
+    row0 = min([0, row1.min(initial = 0)] + [p[:, 1].min() for p in pixel_polygons if len(p)])
+    x_end = max([width_pixels, x2.max(initial = 0)] + [p[:, 0].max() for p in pixel_polygons if len(p)])
+    row_end = max([height_pixels, row2.max(initial = 0)] + [p[:, 1].max() for p in pixel_polygons if len(p)])
+    shape = (row_end - row0 + 1, x_end - x0 + 1)
+
+    # Rectangles are summed as corners of a 2-D difference array.
+    count = numpy.zeros(shape, numpy.int32)
+    numpy.add.at(count, (row1 - row0, x1 - x0), 1)
+    numpy.add.at(count, (row1 - row0, x2 - x0), -1)
+    numpy.add.at(count, (row2 - row0, x1 - x0), -1)
+    numpy.add.at(count, (row2 - row0, x2 - x0), 1)
+    count = count.cumsum(0).cumsum(1)
+    for vertices in pixel_polygons:
+        if len(vertices) and not _fill_polygon(count, vertices, x0, row0):
+            off_grid += 1
+    count = count[:-1, :-1]
+
+    text = numpy.zeros(shape, numpy.int32)
+    numpy.add.at(text, (runs[:, 0] - row0, runs[:, 1] - x0), 1)
+    numpy.add.at(text, (runs[:, 0] - row0, runs[:, 2] - x0), -1)
+    text = text.cumsum(1)[:-1, :-1] > 0
+
+    covered = count > 0
+    extra = covered & ~text
+    missing = text & ~covered
+    tolerance = tolerance_pixels(spec)
+    deviation = max(_deviation(extra, text, tolerance), _deviation(missing, covered, tolerance))
+    return CoverageReport(spec.name, width_pixels, height_pixels,
+                          int(numpy.count_nonzero(text)), len(rects), len(polygons),
+                          int(numpy.count_nonzero(extra)), int(numpy.count_nonzero(missing)),
+                          int(numpy.count_nonzero(count > 1)),
+                          off_grid, tolerance, deviation)
+
+
+# Check a package (an EaglePackage read from a library, or one just built
+# by Label.build_package()) against a fresh rendering of spec, by default
+# the label recorded in its description.
+def verify_package(package, spec = None, renderer = None):
+    if spec is None:
+        spec = spec_from_package(package)
+        if spec is None:
+            raise ValueError('package %s has no eagletext description' % package.name)
+    rects, polygons = package_primitives(package, spec.layer)
+    return verify_primitives(spec, rects, polygons, renderer)
+
+
+# Each worker process keeps its own renderer.
+_worker_renderer = None
+
+def _init_worker():
+    global _worker_renderer
+    _worker_renderer = LabelRenderer()
+
+def _verify_in_worker(spec, rects, polygons):
+    return verify_primitives(spec, rects, polygons, _worker_renderer)
+
+
+# Check every package with an eagletext description in a library (a binary
+# file or a file name), yielding a CoverageReport for each, in order.  The
+# library is read a package at a time.  If jobs > 1, packages are checked
+# in that many processes.
+def verify_library(infile, jobs = 1, renderer = None):
+    if isinstance(infile, str):
+        with open(infile, 'rb') as f:
+            yield from verify_library(f, jobs, renderer)
+        return
+
+    def packages():
+        for item in iter_library(infile):
+            if not isinstance(item, EaglePackage):
+                continue
+            spec = spec_from_package(item)
+            if spec is not None:
+                yield (spec,) + package_primitives(item, spec.layer)
+
+    if jobs <= 1:
+        if renderer is None:
+            renderer = LabelRenderer()
+        for spec, rects, polygons in packages():
+            yield verify_primitives(spec, rects, polygons, renderer)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    window = jobs * 4
+    pending = deque()
+    with ProcessPoolExecutor(max_workers = jobs, initializer = _init_worker) as executor:
+        for args in packages():
+            pending.append(executor.submit(_verify_in_worker, *args))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+# Benchmark the stages of rasterized text library generation
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Each stage of generating a library is timed over a matrix of fonts,
+# sizes, resolutions, text lengths and label counts:
+#   rasterize    measuring and drawing each label with a RasterSession
+#   row_iter     the original per-pixel RasterRowIterator scan (--row-iter)
+#   runs         run extraction from the drawn surfaces with extract_runs()
+#   decompose    merging runs into rectangles with coalesce_runs()
+#   build        building EaglePackage/EagleRectangle objects for every label
+#   build_compact  the same with EagleCompactPackage
+#   write        EagleFile.write of the whole library
+# Results are written as JSON Lines, one record per stage per case, with
+# the best time of --repeat runs, the peak Python memory (from tracemalloc,
+# so Cairo's own allocations aren't included; surface_bytes covers the
+# surface), and the number of runs or primitives involved.  The first
+# record describes the environment.
+
+import argparse
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import cairocffi
+
+from Eagle import EagleLibraryFile, EaglePackage, EagleCompactPackage
+from Rasterize import RasterSession, RasterRowIterator, extract_runs
+from Decompose import coalesce_runs
+
+
+_sample = 'The quick brown fox jumps over the lazy dog 0123456789 R1 C22 U103 '
+
+
+def sample_text(length, index = 0):
+    start = (index * 7) % len(_sample)
+    text = (_sample * (length // len(_sample) + 2))[start:start + length]
+    return text.strip() or 'X'
+
+
+# Run fn repeat times and return its result, the best wall time, and the
+# peak traced memory of one more run.
+def measure(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+
+# A label drawn into its own session's surface, which is exactly its size.
+class DrawnLabel:
+    def __init__(self, text, resolution, font, size):
+        self.session = RasterSession(resolution, font, size, False, False, False)
+        x_bearing, y_bearing, width, height, x_advance, y_advance = self.session.measure(text)
+        self.width_pixels = int(width * resolution)
+        self.height_pixels = int(height * resolution)
+        self.session.draw_text(text, -x_bearing, -y_bearing, self.width_pixels, self.height_pixels)
+        self.surface = self.session.surface
+
+    def get_size_pixels(self):
+        return (self.width_pixels, self.height_pixels)
+
+
+def legacy_runs(raster):
+    width_pixels, height_pixels = raster.get_size_pixels()
+    count = 0
+    for y in range(height_pixels):
+        for x1p, x2p, p in RasterRowIterator(raster.surface, height_pixels - 1 - y):
+            if p[0] != 0:
+                count += 1
+    return count
+
+
+def build_package(cls, name, rects, height_pixels, resolution, overlap = 10.0):
+    overlap = overlap/(200 * resolution)
+    package = cls(name)
+    it = iter(rects)
+    for x1p, row1, x2p, row2 in zip(it, it, it, it):
+        y1 = (height_pixels - row2) / resolution - overlap
+        y2 = (height_pixels - row1) / resolution + overlap
+        package.add_rectangle(21,
+                              x1p / resolution * 25.4, y1 * 25.4,
+                              x2p / resolution * 25.4, y2 * 25.4)
+    return package
+
+
+def build_library(cls, labels, resolution):
+    lib = EagleLibraryFile()
+    for i, (raster, rects) in enumerate(labels):
+        lib.add_package(build_package(cls, 'LABEL%d' % i, rects, raster.get_size_pixels()[1], resolution))
+    return lib
+
+
+def write_library(lib):
+    out = io.BytesIO()
+    lib.write(out)
+    return out.tell()
+
+
+def run_case(args, font, size, resolution, length, label_count, emit):
+    case = { 'font': font, 'size': size, 'dpi': resolution, 'length': length, 'labels': label_count }
+
+    def record(stage, seconds, peak, **counts):
+        emit(dict(case, stage = stage, seconds = seconds, peak_bytes = peak, **counts))
+
+    texts = [sample_text(length, i) for i in range(label_count)]
+    def rasterize():
+        return [DrawnLabel(text, resolution, font, size) for text in texts]
+    rasters, seconds, peak = measure(rasterize, args.repeat)
+    surface_bytes = sum(r.surface.get_stride() * r.surface.get_height() for r in rasters)
+    record('rasterize', seconds, peak,
+           pixels = sum(w * h for w, h in (r.get_size_pixels() for r in rasters)),
+           surface_bytes = surface_bytes)
+
+    if args.row_iter:
+        count, seconds, peak = measure(lambda: sum(legacy_runs(r) for r in rasters), args.repeat)
+        record('row_iter', seconds, peak, runs = count)
+
+    def runs():
+        return [extract_runs(r.surface, True, *r.get_size_pixels()) for r in rasters]
+    runs, seconds, peak = measure(runs, args.repeat)
+    record('runs', seconds, peak, runs = sum(len(r) // 3 for r in runs))
+
+    rects, seconds, peak = measure(lambda: [coalesce_runs(r)[0] for r in runs], args.repeat)
+    record('decompose', seconds, peak, primitives = sum(len(r) // 4 for r in rects))
+
+    labels = list(zip(rasters, rects))
+    primitives = sum(len(r) // 4 for r in rects)
+    lib, seconds, peak = measure(lambda: build_library(EaglePackage, labels, resolution), args.repeat)
+    record('build', seconds, peak, primitives = primitives)
+    compact, seconds, peak = measure(lambda: build_library(EagleCompactPackage, labels, resolution), args.repeat)
+    record('build_compact', seconds, peak, primitives = primitives)
+
+    size_written, seconds, peak = measure(lambda: write_library(lib), args.repeat)
+    record('write', seconds, peak, primitives = primitives, bytes = size_written)
+    size_written, seconds, peak = measure(lambda: write_library(compact), args.repeat)
+    record('write_compact', seconds, peak, primitives = primitives, bytes = size_written)
+
+
+def environment():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True,
+                                  text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return { 'stage': 'environment',
+             'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+             'python': platform.python_version(),
+             'platform': platform.platform(),
+             'cairo': cairocffi.cairo_version_string(),
+             'cairocffi': cairocffi.version,
+             'revision': revision }
+
+
+parser = argparse.ArgumentParser(description = 'Benchmark rasterized text library generation',
+                                 formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-o", "--output",  help = "JSON Lines results file", type = argparse.FileType('w'), default = sys.stdout)
+parser.add_argument("--fonts",         help = "font faces", nargs = '+', default = ['sans', 'serif'])
+parser.add_argument("--sizes",         help = "font sizes in inches", type = float, nargs = '+', default = [0.05, 0.2])
+parser.add_argument("--dpi",           help = "resolutions in dpi", type = int, nargs = '+', default = [300, 600, 1200, 2400])
+parser.add_argument("--lengths",       help = "text lengths in characters", type = int, nargs = '+', default = [4, 16, 64])
+parser.add_argument("--labels",        help = "label counts", type = int, nargs = '+', default = [1, 10])
+parser.add_argument("--repeat",        help = "runs per stage; the best time is reported", type = int, default = 3)
+parser.add_argument("--row-iter",      help = "also time the per-pixel RasterRowIterator scan (slow)", action = 'store_true')
+parser.add_argument("--quick",         help = "a small matrix, for a smoke test", action = 'store_true')
+
+
+def main():
+    args = parser.parse_args()
+    if args.quick:
+        args.fonts = args.fonts[:1]
+        args.sizes = args.sizes[-1:]
+        args.dpi = [300, 1200]
+        args.lengths = [8]
+        args.labels = [1]
+        args.repeat = 1
+
+    def emit(record):
+        print(json.dumps(record, sort_keys = True), file = args.output)
+        if 'seconds' in record:
+            print('%-13s %-6s %5.2f %5d dpi %3d chars %3d labels %9.4f s %10d bytes' %
+                  (record['stage'], record['font'], record['size'], record['dpi'],
+                   record['length'], record['labels'], record['seconds'], record['peak_bytes']),
+                  file = sys.stderr)
+
+    emit(environment())
+    for font in args.fonts:
+        for size in args.sizes:
+            for resolution in args.dpi:
+                for length in args.lengths:
+                    for label_count in args.labels:
+                        run_case(args, font, size, resolution, length, label_count, emit)
+
+
+if __name__ == '__main__':
+    main()
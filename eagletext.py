@@ -16,10 +16,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+from contextlib import ExitStack
+import io
+import itertools
+import json
 import sys
+import threading
 
-from Eagle import EagleLibraryFile, EaglePackage, EagleDeviceset, EagleDevice, EagleRectangle
-from Rasterize import RasterizeText
+from Label import LabelSpec, LabelMeasurer, check_renderer_options, default_name, parse_tolerance, read_manifest, PreviousLibrary
+from Library import generate_library, write_replacing
+from Shards import generate_shards
+from Stats import BuildStats
+from Cache import RenderCache
+from Rasterize import check_threshold
 
 
 # I would like to be able to say things like
@@ -48,10 +57,38 @@ class StrActionStoreOptions(argparse.Action):
         print('%r %r %r' % (namespace, values, option_string))
         setattr(namespace, self.dest, values)
 
-parser = argparse.ArgumentParser(description='Rasterized text library generator for Eagle CAD',
-                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument("text",               help="string to rasterize", type = str, nargs='+')
-parser.add_argument("-o", "--output",     help="new Eagle library file", type=argparse.FileType('wb'), default = sys.stdout)
+# argparse prints help on sys.stdout and errors on sys.stderr.  A thread
+# parsing a command line for someone else (see Server.LabelServer) can
+# send them elsewhere, without affecting other threads, by setting
+# parser.output.stdout and parser.output.stderr.
+class ArgumentParser(argparse.ArgumentParser):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.output = threading.local()
+
+    def _print_message(self, message, file = None):
+        if file is None or file is sys.stderr:
+            file = getattr(self.output, 'stderr', None) or file
+        else:
+            file = getattr(self.output, 'stdout', None) or file
+        super()._print_message(message, file)
+
+def positive_int(text):
+    value = int(text)
+    if value <= 0:
+        raise argparse.ArgumentTypeError('%s is not a positive integer' % text)
+    return value
+
+parser = ArgumentParser(description='Rasterized text library generator for Eagle CAD',
+                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("text",               help="string to rasterize", type = str, nargs='*')
+parser.add_argument("-m", "--manifest",   help = "CSV or JSON Lines file of labels, each with its own options ('-' for stdin)", type = str)
+parser.add_argument("--manifest-format",  help = "manifest format", choices = ['auto', 'csv', 'jsonl'], default = 'auto')
+parser.add_argument("-o", "--output",     help="new Eagle library file (default: stdout, or the --update library)", type=str)
+parser.add_argument("--shards",           help = "split the library into this many files, written beside --output along with a JSON index of them", type = positive_int)
+parser.add_argument("--shard-primitives", help = "split the library into files of about this many primitives (estimated before rendering) each", type = positive_int)
+parser.add_argument("-u", "--update",     help = "existing library to update, re-rendering only labels that are new or have changed", type = str)
+parser.add_argument("--prune",            help = "with --update, drop packages and devicesets that aren't among the labels given", action = 'store_true')
 parser.add_argument("-l", "--layer",      help = "layer number", type = int, default = 21)
 parser.add_argument("-r", "--resolution", help = "resolution in dpi", type = int, default = 600)
 #parser.add_argument("-n", "--name",       help = "device/package name", type = str)
@@ -60,6 +97,21 @@ parser.add_argument("-b", "--bold",       help = "bold", action = 'store_true')
 parser.add_argument("--halign",           help = "horizontal alignment", choices = ['left', 'right', 'center'], default = 'left')
 parser.add_argument("--valign",           help = "vertical alignment", choices = ['top', 'bottom', 'baseline', 'center'], default = 'bottom')
 parser.add_argument("--overlap",          help = "overlap percentage", type = float, default = 10.0)
+parser.add_argument("--antialias",        help = "render with antialiasing (see --threshold)", action = 'store_true')
+parser.add_argument("--threshold",        help = "lowest pixel value, 1 to 255, that counts as part of the text", type = int, default = 1)
+parser.add_argument("--raster-format",    help = "surface format to render into; a8 and a1 use 1/4 and 1/32 the memory", choices = ['rgb24', 'a8', 'a1'], default = 'rgb24')
+parser.add_argument("--strip-height",     help = "render in horizontal strips of this many pixels, to bound memory for very large labels", type = positive_int)
+parser.add_argument("--glyph-cache",      help = "compose text from up to this many cached glyph renderings (0 to render each string whole, as antialiased text always is)", type = int, default = 0)
+parser.add_argument("--cache",            help = "directory to cache rendered labels in, so that unchanged labels aren't rendered again", type = str)
+parser.add_argument("--cache-size",       help = "maximum size of the render cache in megabytes", type = float, default = 256)
+parser.add_argument("--cache-stamp",      help = "anything else the rendering depends on (e.g., a font package version); entries with a different stamp aren't used", type = str, default = '')
+parser.add_argument("--simplify",         help = "merge rectangles that differ by up to this many pixels, or millimetres with an 'mm' suffix, moving edges by no more than that", type = str)
+parser.add_argument("--measure",          help = "don't make a library; write each label's size, bearings, alignment offsets and estimated primitive count as JSON Lines", action = 'store_true')
+parser.add_argument("-p", "--polygon",    help = "trace outlines as polygons instead of rectangles", action = 'store_true')
+parser.add_argument("--debug-png",        help = "directory to write each label's raster to, as <name>.png (not with --strip-height or --glyph-cache)", type = str)
+parser.add_argument("-j", "--jobs",       help = "number of labels to render in parallel", type = int, default = 1)
+parser.add_argument("-v", "--verbose",    help = "report primitive counts on stderr", action = 'store_true')
+parser.add_argument("--stats",            help = "write per-label and total stage times and sizes as JSON to this file (stderr if no file given)", type = str, nargs = '?', const = '-')
 
 slant_group = parser.add_mutually_exclusive_group()
 slant_group.add_argument("-i", "--italic",     help = "italic", action = 'store_true')
@@ -68,71 +120,132 @@ slant_group.add_argument("--oblique",          help = "italic", action = 'store_
 parser.add_argument("-s", "--size",       help = "font size in inches (float)", type = float, default = 0.2)
 
 
-args = parser.parse_args()
-#print(args)
-
-layer = args.layer
-
-
-lib = EagleLibraryFile()
-
-for text in args.text:
-    #if args.name is None:
-    #    args.name = args.text.upper().replace(' ', '_')
-    name = text.upper().replace(' ', '_')
-
-    package_name = name
-    deviceset_name = name
-
-    raster = RasterizeText(text, args.resolution, args.font, args.size, args.bold, args.italic, args.oblique)
-
-    width_pixels, height_pixels = raster.get_size_pixels()
-    x_origin, y_origin = raster.get_origin()
-
-    package = EaglePackage(package_name)
-
-    overlap = args.overlap/(200 * args.resolution)
-
-    yoffset = 0
-    if args.valign == 'top':
-        yoffset = height_pixels/args.resolution
-    elif args.valign == 'bottom':
-        pass
-    elif args.valign == 'baseline':
-        yoffset = height_pixels/args.resolution - y_origin
-    elif args.valign == 'center':
-        yoffset = height_pixels/(2*args.resolution)
-    #elif args.valign == 'center-above-baseline':
-    #    yoffset = ?
-
-    xoffset = 0
-    if args.halign == 'left':
-        pass
-    elif args.halign == 'right':
-        xoffset = width_pixels/args.resolution
-    elif args.halign == 'center':
-        xoffset = width_pixels/(2*args.resolution)
-
-    for y in range(height_pixels):
-        #print("row %d" % y)
-        y1 = y / args.resolution - overlap - yoffset
-        y2 = (y + 1) / args.resolution + overlap - yoffset
-        ri = raster.row_iter(height_pixels - 1 - y)
-        for x1p, x2p, p in ri:
-            #print(x1p, x2p, ['%d' % p[i] for i in range(len(p))])
-            x1 = x1p / args.resolution - xoffset
-            x2 = x2p / args.resolution - xoffset
-            if p[0] != 0:
-                package.add_primitive(EagleRectangle(layer,
-                                                     x1 * 25.4, y1 * 25.4,
-                                                     x2 * 25.4, y2 * 25.4))
-
-    lib.add_package(package)
-
-    deviceset = EagleDeviceset(deviceset_name)
-    device = EagleDevice('', package_name)
-    deviceset.add_device(device)
-    
-    lib.add_deviceset(deviceset)
-
-lib.write(args.output)
+# The options that name files or directories.
+path_options = ('manifest', 'output', 'update', 'stats', 'debug_png', 'cache')
+
+
+# Generate the library described by args, as parsed by parser.  stdin,
+# stdout and stderr default to sys.stdin, sys.stdout and sys.stderr; stdout
+# may be a text or binary file.  renderer, if given, is the
+# Label.LabelRenderer to use (when not rendering in parallel), so that its
+# fonts and caches stay warm from one library to the next; measurer, the
+# Label.LabelMeasurer (of renderer) to use for --measure, likewise keeps
+# the extents it has measured.
+def generate(args, stdin = None, stdout = None, stderr = None, renderer = None, measurer = None):
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    if not args.text and args.manifest is None:
+        raise ValueError('no text or manifest given')
+
+    if args.simplify:
+        parse_tolerance(args.simplify)
+    check_threshold(args.threshold)
+    check_renderer_options(**renderer_options(args))
+    sharded = args.shards or args.shard_primitives
+    if sharded and (args.output is None or args.output == '-'):
+        raise ValueError('--shards and --shard-primitives need an --output file')
+    if sharded and args.update is not None:
+        raise ValueError('a sharded library is updated by building it again, not with --update')
+    if args.measure and (sharded or args.update is not None):
+        raise ValueError('--measure writes no library to shard or update')
+    if args.measure and args.stats is not None:
+        raise ValueError('--measure builds no library to give --stats for')
+
+    with ExitStack() as files:
+        defaults = LabelSpec(None, None, args.resolution, args.font, args.size,
+                             args.bold, args.italic, args.oblique,
+                             args.layer, args.halign, args.valign, args.overlap, args.polygon,
+                             args.antialias, args.threshold, args.simplify)
+        specs = (defaults._replace(text = text, name = default_name(text)) for text in args.text)
+        if args.manifest is not None:
+            if args.manifest == '-':
+                manifest = stdin
+            else:
+                manifest = files.enter_context(open(args.manifest, newline = ''))
+            specs = itertools.chain(specs, read_manifest(manifest, defaults, args.manifest_format))
+
+        stats = None
+        if args.stats is not None:
+            stats = BuildStats()
+
+        if args.measure:
+            if measurer is None:
+                measurer = LabelMeasurer(renderer)
+            if args.output is None or args.output == '-':
+                write_metrics(specs, stdout, measurer)
+            else:
+                with open(args.output, 'w') as f:
+                    write_metrics(specs, f, measurer)
+            return
+
+        previous = None
+        if args.update is not None:
+            previous = PreviousLibrary(files.enter_context(open(args.update, 'rb')), args.prune)
+
+        output = args.output
+        if output is None and args.update is not None:
+            output = args.update
+        if sharded:
+            generate_shards(specs, output, args.shards, args.shard_primitives, args.jobs,
+                            render_cache(args), renderer, stats, stderr if args.verbose else None,
+                            **renderer_options(args))
+        elif output is None or output == '-':
+            write_library(args, specs, previous, stats, stdout, stderr, renderer)
+        else:
+            # Write to a temporary file beside the library, and only replace
+            # it once the new one is complete, so that a build that fails
+            # part way (e.g., on a clashing label name, which isn't found
+            # until the label is reached) leaves no broken library, and an
+            # updated library can be read while it is rewritten.
+            write_replacing(output, 'wb',
+                            lambda f: write_library(args, specs, previous, stats, f, stderr, renderer))
+
+        if stats is not None:
+            if args.stats == '-':
+                stats.write_json(stderr)
+            else:
+                with open(args.stats, 'w') as f:
+                    stats.write_json(f)
+
+
+def render_cache(args):
+    if args.cache is None:
+        return None
+    return RenderCache(args.cache, int(args.cache_size * (1 << 20)), args.cache_stamp)
+
+
+def renderer_options(args):
+    return { 'glyph_cache_size': args.glyph_cache,
+             'debug_png_dir':    args.debug_png,
+             'raster_format':    args.raster_format,
+             'strip_height':     args.strip_height }
+
+
+# outfile may be a text or binary file.
+def write_metrics(specs, outfile, measurer):
+    binary = not isinstance(outfile, io.TextIOBase)
+    for spec in specs:
+        line = json.dumps(measurer.measure(spec)._asdict()) + '\n'
+        outfile.write(line.encode('utf-8') if binary else line)
+
+
+def write_library(args, specs, previous, stats, outfile, stderr, renderer = None):
+    generate_library(specs, outfile, args.jobs, render_cache(args), renderer, previous, stats,
+                     stderr if args.verbose else None, **renderer_options(args))
+
+
+def main():
+    args = parser.parse_args()
+    if not args.text and args.manifest is None:
+        parser.error('no text or manifest given')
+    try:
+        generate(args)
+    except (ValueError, OSError) as e:
+        sys.exit('%s: %s' % (parser.prog, e))
+
+
+# Worker processes for --jobs may import this module, so only do the
+# work when it is run as a script.
+if __name__ == '__main__':
+    main()
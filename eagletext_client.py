@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+# Run an eagletext.py command line on an eagletext_server.py server
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Takes exactly the same arguments as eagletext.py, and produces the
+# same output and exit status, but has the server at $EAGLETEXT_SERVER
+# (or the default socket; see Server.default_address()) do the work.  This
+# deliberately doesn't use argparse or import anything from eagletext.py,
+# so that it starts quickly.
+
+import sys
+
+from Server import run_client, default_address
+
+
+def main():
+    try:
+        status = run_client(default_address(), sys.argv[1:])
+    except (OSError, EOFError, ValueError) as e:
+        sys.exit('%s: can\'t reach server at %s: %s' % (sys.argv[0], default_address(), e))
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+# Serve rasterized text library generation requests from eagletext_client.py
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+
+from Server import LabelServer, default_address
+
+
+parser = argparse.ArgumentParser(description = 'Rasterized text library generation server for Eagle CAD',
+                                 formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-a", "--address",      help = "Unix socket path, or [host]:port to listen on, where host must be a loopback address (default: $EAGLETEXT_SERVER or a socket in the temporary directory)", type = str)
+parser.add_argument("-n", "--max-requests", help = "number of requests to run at once; others wait", type = int, default = 4)
+
+
+def main():
+    args = parser.parse_args()
+    try:
+        server = LabelServer(args.address or default_address(), args.max_requests)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
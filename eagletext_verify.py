@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# Check that the packages of Eagle CAD libraries cover exactly the pixels of their text
+# Copyright 2016 Eric Smith <spacewar@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the version 3 of the GNU General Public License
+# as published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import sys
+from xml.etree.ElementTree import ParseError
+
+from Verify import verify_library, passed
+
+
+parser = argparse.ArgumentParser(description = 'Coverage verifier for libraries made by eagletext.py',
+                                 formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("library",       help = "Eagle library file to check", type = str, nargs = '+')
+parser.add_argument("-j", "--jobs",  help = "number of packages to check in parallel", type = int, default = 1)
+parser.add_argument("-v", "--verbose", help = "report every package, not just those that fail", action = 'store_true')
+parser.add_argument("--json",        help = "report as JSON Lines, one object per package", action = 'store_true')
+
+
+def main():
+    args = parser.parse_args()
+    checked = 0
+    failed = 0
+    try:
+        for library in args.library:
+            for report in verify_library(library, args.jobs):
+                checked += 1
+                ok = passed(report)
+                if not ok:
+                    failed += 1
+                if ok and not args.verbose:
+                    continue
+                if args.json:
+                    record = report._asdict()
+                    record['library'] = library
+                    record['passed'] = ok
+                    print(json.dumps(record))
+                else:
+                    print('%s: %s: %s: %d pixels, %d extra, %d missing, %d overlapping, %d primitives off grid%s' %
+                          (library, report.name, 'ok' if ok else 'FAILED', report.pixels,
+                           report.extra, report.missing, report.overlap, report.off_grid,
+                           ' (simplified: %d pixels off, tolerance %d)' % (report.deviation, report.tolerance)
+                           if report.tolerance else ''))
+    except (ValueError, OSError, ParseError, ImportError) as e:
+        sys.exit('%s: %s' % (parser.prog, e))
+    if not args.json:
+        print('%d packages checked, %d failed' % (checked, failed), file = sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()